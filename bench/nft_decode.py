@@ -0,0 +1,55 @@
+"""
+time of decoding one NFT coin from its parent spend, the work of the watcher and the address sync for every NFT coin
+
+    python -m bench.nft_decode --runs 300
+
+the parent is an NFT spend with a metadata, an ownership layer with the default royalty transfer program and
+a standard p2 puzzle, which transfers the NFT to an address and sets its owner DID.
+"""
+import argparse
+import os
+import timeit
+from openapi.puzzles import (
+    SINGLETON_LAUNCHER_MOD_HASH, SINGLETON_TOP_LAYER_MOD, SINGLETON_TOP_LAYER_MOD_HASH, NFT_STATE_LAYER_MOD,
+    NFT_STATE_LAYER_MOD_HASH, NFT_METADATA_UPDATER, NFT_OWNERSHIP_LAYER, NFT_TRANSFER_PROGRAM_DEFAULT, STANDARD_PUZZLE_MOD,
+)
+from openapi.singleton import get_singleton_info_from_coin_spend
+from openapi.types import Coin, CoinSpend, Program
+
+
+def nft_transfer_spend():
+    """
+    the parent spend, the new NFT coin and its address and owner DID
+    """
+    launcher_id = os.urandom(32)
+    address = os.urandom(32)
+    did_id = os.urandom(32)
+    struct = Program.to((SINGLETON_TOP_LAYER_MOD_HASH, (launcher_id, SINGLETON_LAUNCHER_MOD_HASH)))
+    transfer = NFT_TRANSFER_PROGRAM_DEFAULT.curry(struct, os.urandom(32), 300)
+    p2 = STANDARD_PUZZLE_MOD.curry(os.urandom(48))
+    ownership = NFT_OWNERSHIP_LAYER.curry(NFT_OWNERSHIP_LAYER.get_tree_hash(), did_id, transfer, p2)
+    metadata = Program.to([(b'u', [b'https://example.com/nft.png']), (b'h', os.urandom(32))])
+    state = NFT_STATE_LAYER_MOD.curry(NFT_STATE_LAYER_MOD_HASH, metadata, NFT_METADATA_UPDATER.get_tree_hash(), ownership)
+    puzzle = SINGLETON_TOP_LAYER_MOD.curry(struct, state)
+
+    # the p2 delegated puzzle returns the conditions: create the NFT coin hinted to the address, set the owner DID
+    conditions = [[51, address, 1, [address]], [-10, did_id, [], os.urandom(32)]]
+    p2_solution = Program.to([[], (1, conditions), []])
+    solution = Program.to([[os.urandom(32), os.urandom(32), 1], 1, [[p2_solution]]])
+    parent = Coin(os.urandom(32), puzzle.get_tree_hash(), 1)
+    coin = Coin(parent.name(), os.urandom(32), 1)
+    return CoinSpend(parent, puzzle, solution), coin, address, did_id
+
+
+def main(runs: int):
+    parent_cs, coin, address, did_id = nft_transfer_spend()
+    asset_type, asset_info = get_singleton_info_from_coin_spend(coin, parent_cs, address)
+    assert asset_type == 'nft' and asset_info[1] == did_id, (asset_type, asset_info)
+    cost = timeit.timeit(lambda: get_singleton_info_from_coin_spend(coin, parent_cs, address), number=runs)
+    print(f'{cost / runs * 1e3:.2f} ms per nft coin, {runs} runs')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=300)
+    main(parser.parse_args().runs)
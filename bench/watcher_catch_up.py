@@ -0,0 +1,132 @@
+"""
+catch-up throughput of the watcher, against a local fake full node serving synthetic blocks, on a fresh sqlite database
+
+    python -m bench.watcher_catch_up --blocks 2000 --batch-sizes 1 100
+
+run it from the repo root with a settings.toml, the SQLITE pragmas of settings.toml apply.
+every block spends `--spends` standard coins of the previous block, each spend creates a payment (even amount)
+and a change coin (odd amount). with --synced-address an address is in address_sync, so the watcher also fetches
+and scans the spends of every block with odd additions for singletons.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict, List
+from aiohttp import web
+from openapi.db import create_database, save_address_sync_height
+from openapi.migrations import migrate
+from openapi.puzzles import STANDARD_PUZZLE_MOD
+from openapi.types import Program
+from openapi.utils import coin_name
+from openapi.watcher import Watcher
+
+
+def to_hex(b: bytes) -> str:
+    return '0x' + b.hex()
+
+
+class FakeNode:
+
+    def __init__(self, blocks: int, spends: int):
+        self.peak = blocks - 1
+        puzzles = [STANDARD_PUZZLE_MOD.curry(os.urandom(48)) for _ in range(50)]
+        solution = Program.to([[], (1, []), []])
+        # header hash -> (additions, removals, block spends)
+        self.block_coins: Dict[str, tuple] = {}
+        self.header_hashes: List[str] = []
+        unspent = [(None, None)] * spends
+        for height in range(blocks):
+            header_hash = os.urandom(32).hex()
+            self.header_hashes.append(header_hash)
+            additions, removals, block_spends, created = [], [], [], []
+            for i, (parent, parent_puzzle) in enumerate(unspent):
+                if parent is not None:
+                    removals.append({'coin': parent, 'confirmed_block_index': height - 1, 'coinbase': False})
+                    block_spends.append({
+                        'coin': parent, 'puzzle_reveal': bytes(parent_puzzle).hex(), 'solution': bytes(solution).hex()})
+                    parent_id = coin_name(**parent)
+                else:
+                    parent_id = os.urandom(32)
+                for amount in (1000 + 2 * i, 1001 + 2 * i):
+                    puzzle = puzzles[(height + i + amount) % len(puzzles)]
+                    coin = {'parent_coin_info': to_hex(parent_id), 'puzzle_hash': to_hex(puzzle.get_tree_hash()), 'amount': amount}
+                    additions.append({'coin': coin, 'confirmed_block_index': height, 'coinbase': False})
+                    created.append((coin, puzzle))
+            self.block_coins[header_hash] = (additions, removals, block_spends)
+            unspent = created[:spends]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        body = await request.json()
+        if method == 'get_blockchain_state':
+            return web.json_response({'success': True, 'blockchain_state': {'peak': {'height': self.peak}, 'sync': {'synced': True}}})
+        if method == 'get_block_record_by_height':
+            height = body['height']
+            return web.json_response({'success': True, 'block_record': {
+                'header_hash': to_hex(bytes.fromhex(self.header_hashes[height])), 'height': height, 'timestamp': 1000 + height,
+                'prev_hash': to_hex(bytes.fromhex(self.header_hashes[height - 1]) if height else bytes(32)),
+            }})
+        additions, removals, block_spends = self.block_coins[body['header_hash'][-64:]]
+        if method == 'get_additions_and_removals':
+            return web.json_response({'success': True, 'additions': additions, 'removals': removals})
+        if method == 'get_block_spends':
+            return web.json_response({'success': True, 'block_spends': block_spends})
+        return web.json_response({'success': False, 'error': f'unknown method {method}'})
+
+
+class CatchUpWatcher(Watcher):
+
+    async def wait_for_peak(self):
+        # caught up
+        raise asyncio.CancelledError
+
+
+async def run(node: FakeNode, port: int, batch_size: int, prefetch_window: int, synced_address: bool) -> float:
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    uri = f'sqlite+aiosqlite:///{path}'
+    migrate(uri)
+    db = create_database(uri)
+    if synced_address:
+        await db.connect()
+        await save_address_sync_height(db, os.urandom(32), 0)
+        await db.disconnect()
+    watcher = CatchUpWatcher(f'http://127.0.0.1:{port}', db, start_height=0, prefetch_window=prefetch_window,
+                             catch_up_batch_size=batch_size)
+    start = time.monotonic()
+    try:
+        await watcher.start()
+    except asyncio.CancelledError:
+        pass
+    cost = time.monotonic() - start
+    await db.disconnect()
+    return cost
+
+
+async def main(args):
+    node = FakeNode(args.blocks, args.spends)
+    app = web.Application()
+    app.router.add_post('/{method}', node.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    try:
+        for _ in range(args.runs):
+            for batch_size in args.batch_sizes:
+                cost = await run(node, args.port, batch_size, args.prefetch_window, args.synced_address)
+                print(f'catch_up_batch_size={batch_size}: {args.blocks} blocks in {cost:.2f}s, {args.blocks / cost:.1f} blocks/s')
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--spends', type=int, default=10, help='standard coin spends per block')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100])
+    parser.add_argument('--prefetch-window', type=int, default=10)
+    parser.add_argument('--synced-address', action='store_true')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--port', type=int, default=18644)
+    asyncio.run(main(parser.parse_args()))
@@ -3,15 +3,15 @@ import logging
 import logzero
 
 
+from .config import settings
+
 cwd = os.path.dirname(__file__)
 
-log_dir = os.path.join(cwd, "../", "logs")
+log_dir = settings.get('LOG_DIR') or os.path.join(cwd, "../", "logs")
 
 if not os.path.exists(log_dir):
     os.mkdir(log_dir)
 
-from .config import settings
-
 logger = logzero.setup_logger(
     __name__, level=logging.getLevelName(settings['LOG_LEVEL']), logfile=os.path.join(log_dir, "api.log"),
     disableStderrLogger=True)
\ No newline at end of file
@@ -1,21 +1,27 @@
 import os
 import json
+import base64
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import asyncio
 import logging
-from fastapi import FastAPI, APIRouter, Request, Body, Depends, HTTPException
+from fastapi import FastAPI, APIRouter, Request, Response, Body, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from aiocache import caches, cached, Cache
 from pydantic import BaseModel
-from .utils import int_to_hex, hexstr_to_bytes, to_hex, sanitize_obj_hex
+from .utils import int_to_hex, hexstr_to_bytes, to_hex, sanitize_obj_hex, coin_name
+from .utils.lru_cache import LRUCache
 from .utils.bech32m import decode_puzzle_hash, encode_puzzle_hash
 from .utils.singleflight import SingleFlight
-from .rpc_client import FullNodeRpcClient
+from .scheduler import SyncScheduler
+from .rpc_client import FullNodeRpcClient, create_rpc_client
 from .types import Coin, Program
 from .sync import sync_user_assets, get_and_sync_singleton
-from .db import get_db, get_assets, register_db, connect_db, disconnect_db, get_metadata_by_hashes
+from .db import (
+    get_db, get_read_db, get_assets, register_db, connect_db, disconnect_db, get_metadata_by_hashes,
+    get_indexed_unspent_coin_records, get_indexed_balances, get_address_sync_height, get_latest_tx_block_number,
+)
 from .config import settings
 
 
@@ -47,10 +53,7 @@ async def init_chains(app, chains_config):
 
         rpc_url_or_chia_path = row.get('rpc_url_or_chia_path')
         if rpc_url_or_chia_path:
-            if rpc_url_or_chia_path.startswith("http"):
-                client = await FullNodeRpcClient.create_by_proxy_url(rpc_url_or_chia_path)
-            else:
-                client = await FullNodeRpcClient.create_by_chia_root_path(rpc_url_or_chia_path)
+            client = await create_rpc_client(rpc_url_or_chia_path, **settings.get('RPC', {}))
         else:
             raise ValueError(f"chian {row['id']} has no full node rpc config")
         
@@ -59,7 +62,7 @@ async def init_chains(app, chains_config):
         chain = Chain(id_hex, row['network_name'], row['network_prefix'], client)
         chains[chain.id] = chain
         chains[chain.network_name] = chain
-        register_db(chain.id, row['database_uri'])
+        register_db(chain.id, row['database_uri'], row.get('read_database_uri'))
         await connect_db(chain.id)
 
     app.state.chains = chains
@@ -69,11 +72,13 @@ async def init_chains(app, chains_config):
 async def startup():
     logger.info("begin init")
     await init_chains(app, settings.SUPPORTED_CHAINS.values())
+    sync_scheduler.start()
     logger.info("finish init")
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await sync_scheduler.stop()
     for chain in app.state.chains.values():
         chain.client.close()
         await chain.client.await_closed()
@@ -117,19 +122,150 @@ def coin_javascript_compat(coin):
     }
 
 
+async def get_unspent_coins_from_node(chain: Chain, puzzle_hashes: List[bytes]) -> Dict[bytes, List[Dict]]:
+    coins = {ph: [] for ph in puzzle_hashes}
+    coin_records = await chain.client.get_coin_records_by_puzzle_hashes(puzzle_hashes=puzzle_hashes, include_spent_coins=False)
+    for row in coin_records:
+        if row['spent']:
+            continue
+        coins[hexstr_to_bytes(row['coin']['puzzle_hash'])].append(row['coin'])
+    return coins
+
+
+# while the watcher is more than this many blocks behind the peak, the coin index misses the spends
+# of the blocks it has not reached, coins and balances are then read from the full node only
+COIN_INDEX_MAX_LAG = settings.get('WATCHER', {}).get('coin_index_max_lag', 2)
+# seconds the peak of the lag check is reused
+COIN_INDEX_PEAK_MAX_AGE = settings.get('WATCHER', {}).get('coin_index_peak_max_age', 3)
+
+# (chain id, header hash) -> (additions, removals) of the blocks after the coin index
+recent_block_coins = LRUCache(4 * (COIN_INDEX_MAX_LAG + 1))
+
+
+async def get_coin_index_peak(chain: Chain, start_height: Optional[int], end_height: Optional[int]) -> Optional[int]:
+    """
+    the peak height when the coin index can be read, None when the coins are read from the full node:
+    the index does not start from the genesis block, or the watcher lags
+    """
+    if start_height != 0:
+        return None
+    peak_height = await chain.client.get_peak_height(COIN_INDEX_PEAK_MAX_AGE)
+    if peak_height - end_height > COIN_INDEX_MAX_LAG:
+        return None
+    return peak_height
+
+
+async def get_recent_block_coins(chain: Chain, height: int) -> Tuple[List[Dict], List[Dict]]:
+    block = await chain.client.get_block_record_by_height(height)
+    if not block['timestamp']:
+        # not a transaction block
+        return [], []
+    key = (chain.id, block['header_hash'])
+    coins = recent_block_coins.get(key)
+    if coins is None:
+        coins = await chain.client.get_additions_and_removals(hexstr_to_bytes(block['header_hash']), height)
+        recent_block_coins.put(key, coins)
+    return coins
+
+
+async def get_coin_index_tail(chain: Chain, puzzle_hashes: List[bytes], end_height: int,
+                              peak_height: int) -> Tuple[Dict[bytes, List[Dict]], Dict[bytes, Dict]]:
+    """
+    the coins of the blocks after the coin index, up to coin_index_max_lag blocks:
+    additions: puzzle_hash -> coins created, removals: coin id -> coin spent
+    """
+    puzzle_hash_set = set(puzzle_hashes)
+    additions = {ph: [] for ph in puzzle_hashes}
+    removals = {}
+    for height in range(end_height + 1, peak_height + 1):
+        block_additions, block_removals = await get_recent_block_coins(chain, height)
+        for coin_record in block_additions:
+            puzzle_hash = hexstr_to_bytes(coin_record['coin']['puzzle_hash'])
+            if puzzle_hash in puzzle_hash_set:
+                additions[puzzle_hash].append(coin_record['coin'])
+        for coin_record in block_removals:
+            if hexstr_to_bytes(coin_record['coin']['puzzle_hash']) in puzzle_hash_set:
+                removals[coin_name(**coin_record['coin'])] = coin_record['coin']
+    return additions, removals
+
+
+async def get_unspent_coins(chain: Chain, puzzle_hashes: List[bytes]) -> Dict[bytes, List[Dict]]:
+    """
+    read unspent coins from the watcher's coin index, and the blocks after it from the full node
+    """
+    start_height, end_height, rows = await get_indexed_unspent_coin_records(get_read_db(chain.id), puzzle_hashes)
+    peak_height = await get_coin_index_peak(chain, start_height, end_height)
+    if peak_height is None:
+        return await get_unspent_coins_from_node(chain, puzzle_hashes)
+    additions, removals = await get_coin_index_tail(chain, puzzle_hashes, end_height, peak_height)
+    coins = {ph: [] for ph in puzzle_hashes}
+    for row in rows:
+        if bytes(row['coin_id']) not in removals:
+            coins[bytes(row['puzzle_hash'])].append(row['coin'])
+    for ph, added in additions.items():
+        coins[ph].extend(coin for coin in added if coin_name(**coin) not in removals)
+    return coins
+
+
+async def get_address_balances(chain: Chain, puzzle_hashes: List[bytes]) -> Dict[bytes, Dict]:
+    """
+    read the balances from the watcher's coin index, one primary key read per address,
+    and apply the coins of the blocks after it
+    """
+    start_height, end_height, rows = await get_indexed_balances(get_read_db(chain.id), puzzle_hashes)
+    peak_height = await get_coin_index_peak(chain, start_height, end_height)
+    if peak_height is None:
+        node_coins = await get_unspent_coins_from_node(chain, puzzle_hashes)
+        return {
+            ph: {'amount': sum(coin['amount'] for coin in coins), 'coin_num': len(coins)}
+            for ph, coins in node_coins.items()
+        }
+    balances = {ph: {'amount': 0, 'coin_num': 0} for ph in puzzle_hashes}
+    for row in rows:
+        balances[bytes(row['puzzle_hash'])] = {'amount': int(row['amount']), 'coin_num': row['coin_num']}
+    additions, removals = await get_coin_index_tail(chain, puzzle_hashes, end_height, peak_height)
+    for ph, added in additions.items():
+        balances[ph]['amount'] += sum(coin['amount'] for coin in added)
+        balances[ph]['coin_num'] += len(added)
+    # the coins spent after the index were created in it or in the blocks after it, both are counted above
+    for coin in removals.values():
+        balance = balances[hexstr_to_bytes(coin['puzzle_hash'])]
+        balance['amount'] -= coin['amount']
+        balance['coin_num'] -= 1
+    return balances
+
+
+MAX_BATCH_ADDRESSES = 100
+
+
+class AddressesBody(BaseModel):
+    addresses: List[str]
+
+
+def decode_addresses(addresses: List[str], prefix) -> List[bytes]:
+    if not addresses or len(addresses) > MAX_BATCH_ADDRESSES:
+        raise HTTPException(400, f"`addresses` should contain 1 to {MAX_BATCH_ADDRESSES} addresses")
+    return [decode_address(address, prefix) for address in addresses]
+
+
 @router.get("/utxos", response_model=List[UTXO])
 @cached(ttl=10, key_builder=lambda *args, **kwargs: f"utxos:{kwargs['address']}", alias='default')
 async def get_utxos(address: str, chain: Chain = Depends(get_chain)):
-    # todo: use block indexer
     pzh = decode_address(address, chain.network_prefix)
 
-    coin_records = await chain.client.get_coin_records_by_puzzle_hash(puzzle_hash=pzh, include_spent_coins=False)
     data = []
+    for coin in (await get_unspent_coins(chain, [pzh]))[pzh]:
+        data.append(coin_javascript_compat(coin))
+    return data
 
-    for row in coin_records:
-        if row['spent']:
-            continue
-        data.append(coin_javascript_compat(row['coin']))
+
+@router.post("/utxos", response_model=Dict[str, List[UTXO]])
+async def get_batch_utxos(item: AddressesBody, chain: Chain = Depends(get_chain)):
+    puzzle_hashes = decode_addresses(item.addresses, chain.network_prefix)
+    coins = await get_unspent_coins(chain, list(set(puzzle_hashes)))
+    data = {}
+    for address, ph in zip(item.addresses, puzzle_hashes):
+        data[address] = [coin_javascript_compat(coin) for coin in coins[ph]]
     return data
 
 
@@ -179,57 +315,83 @@ async def full_node_rpc(item: ChiaRpcParams, chain: Chain = Depends(get_chain)):
 @router.get('/balance')
 @cached(ttl=10, key_builder=lambda *args, **kwargs: f"balance:{kwargs['address']}", alias='default')
 async def query_balance(address: str, chain: Chain = Depends(get_chain)):
-    # todo: use block indexer
     puzzle_hash = decode_address(address, chain.network_prefix)
-    coin_records = await chain.client.get_coin_records_by_puzzle_hash(puzzle_hash=puzzle_hash, include_spent_coins=False)
-    amount = 0
-    coin_num = 0
-    for row in coin_records:
-        if row['spent']:
-            continue
-        amount += row['coin']['amount']
-        coin_num += 1
-    data = {
-        'amount': amount,
-        'coin_num': coin_num,
-    }
+    return (await get_address_balances(chain, [puzzle_hash]))[puzzle_hash]
+
+
+@router.post('/balances')
+async def query_batch_balances(item: AddressesBody, chain: Chain = Depends(get_chain)):
+    puzzle_hashes = decode_addresses(item.addresses, chain.network_prefix)
+    balances = await get_address_balances(chain, list(set(puzzle_hashes)))
+    data = {}
+    for address, ph in zip(item.addresses, puzzle_hashes):
+        data[address] = balances[ph]
     return data
 
 
 sf = SingleFlight()
 
+sync_scheduler = SyncScheduler(
+    settings.get('SYNC', {}).get('workers', 4), max_pending=settings.get('SYNC', {}).get('max_pending', 10000))
+
 class AssetTypeEnum(str, Enum):
     NFT = "nft"
     DID = "did"
 
 
+def encode_asset_cursor(confirmed_height: int, coin_id: bytes) -> str:
+    return base64.urlsafe_b64encode(f"{confirmed_height}:{coin_id.hex()}".encode()).decode()
+
+
+def decode_asset_cursor(cursor: str) -> Tuple[int, bytes]:
+    try:
+        confirmed_height, coin_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return int(confirmed_height), bytes.fromhex(coin_id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+
 @router.get('/assets')
-async def list_assets(address: str, chain: Chain = Depends(get_chain),
+async def list_assets(address: str, response: Response, chain: Chain = Depends(get_chain),
     asset_type: AssetTypeEnum=AssetTypeEnum.NFT, asset_id: Optional[str]=None,
-    offset=0, limit=10):
+    offset: int=0, limit: int=10, cursor: Optional[str]=None):
     """
     - the api only support did coins that use inner puzzle hash for hint, so some did coins may not return
+    - assets are synced in background, the cached assets are returned immediately,
+      the sync progress is in the `X-Sync-Status` (pending/syncing/synced/error) and `X-Sync-Height` headers
+    - pass the `X-Next-Cursor` header of a full page as `cursor` to get the next page, `offset` is ignored with a cursor
     """
 
     puzzle_hash = decode_address(address, chain.network_prefix)
-    await sf.do(address, lambda: sync_user_assets(chain.id, puzzle_hash, chain.client))
     db = get_db(chain.id)
+    address_sync = await get_address_sync_height(db, puzzle_hash)
+    sync_height = address_sync['height'] if address_sync else 0
+    latest_height = await get_latest_tx_block_number(db)
+    sync_key = (chain.id, puzzle_hash)
+    if latest_height is None or sync_height + 1 < latest_height:
+        sync_scheduler.submit(sync_key, lambda: sync_user_assets(chain.id, puzzle_hash, chain.client))
+    response.headers['X-Sync-Status'] = sync_scheduler.status(sync_key)
+    response.headers['X-Sync-Height'] = str(sync_height)
     # todo: use nftd/did indexer, now use db for cache
     assets = await get_assets(
-        db, asset_type=asset_type, asset_id=hexstr_to_bytes(asset_id) if asset_id else None,
-        p2_puzzle_hash=puzzle_hash, offset=offset, limit=limit
+        get_read_db(chain.id), asset_type=asset_type, asset_id=hexstr_to_bytes(asset_id) if asset_id else None,
+        p2_puzzle_hash=puzzle_hash, offset=None if cursor else offset, limit=limit,
+        cursor=decode_asset_cursor(cursor) if cursor else None,
     )
+    if assets and len(assets) == limit:
+        response.headers['X-Next-Cursor'] = encode_asset_cursor(assets[-1].confirmed_height, bytes(assets[-1].coin_id))
 
     data = []
     for asset in assets:
+        # json columns are read by key, attribute access skips their decoding on postgresql
         item = {
             'asset_type': asset.asset_type,
             'asset_id': to_hex(asset.asset_id),
-            'coin': asset.coin,
+            'coin': asset['coin'],
             'coin_id': to_hex(asset.coin_id),
             'confirmed_height': asset.confirmed_height,
-            'lineage_proof': asset.lineage_proof,
-            'curried_params': asset.curried_params,
+            'lineage_proof': asset['lineage_proof'],
+            'curried_params': asset['curried_params'],
         }
         data.append(item)
 
@@ -1,62 +1,97 @@
-from typing import Optional, List, Any
-from databases import Database
+import sqlite3
+from collections import defaultdict
+from typing import Optional, List, Any, Tuple, Dict
+from databases import Database, DatabaseURL
 import sqlalchemy
-from sqlalchemy import inspect, Column, ForeignKey, Integer, String, BINARY, BLOB, JSON, Boolean
-from sqlalchemy import select, update, insert, delete, func
+from sqlalchemy import inspect, Column, ForeignKey, Integer, String, BINARY, BLOB, JSON, Boolean, Index
+from sqlalchemy import select, update, insert, delete, func, text, literal_column, tuple_
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
+from sqlalchemy.dialects import sqlite, postgresql, mysql
 
-from . import config as settings
+from .config import settings
+from .migrations import SCHEMA_VERSION, schema_version_table
+from .db_writer import DBWriter
 
-KEY_DBS = {}
+# postgresql has no BINARY type
+BYTES32 = BINARY(32).with_variant(postgresql.BYTEA(), 'postgresql')
 
+KEY_DBS = {}
+# optional read replicas for query paths, keyed as KEY_DBS
+KEY_READ_DBS = {}
+KEY_WRITERS: Dict[Any, DBWriter] = {}
 
 
 def get_db(key) -> Database:
     return KEY_DBS[key]
 
 
-def register_db(key, uri):
+def get_read_db(key) -> Database:
+    return KEY_READ_DBS.get(key) or KEY_DBS[key]
+
+
+def get_writer(key) -> DBWriter:
+    return KEY_WRITERS[key]
+
+
+def sqlite_connection_factory(pragmas: Dict[str, Any]):
+    class Connection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            for name, value in pragmas.items():
+                self.execute(f"PRAGMA {name} = {value}")
+    return Connection
+
+
+def create_database(uri: str) -> Database:
+    """
+    every connection the pool opens to a sqlite database applies the pragmas in the SQLITE section of settings.toml
+    """
+    if DatabaseURL(uri).dialect == 'sqlite':
+        pragmas = dict(settings.get('SQLITE', {}))
+        return Database(uri, factory=sqlite_connection_factory(pragmas))
+    return Database(uri)
+
+
+def register_db(key, uri, read_uri=None):
     if key in KEY_DBS:
         raise ValueError(f"db: {key} has exists")
-    KEY_DBS[key] = Database(uri)
-
-
-def create_tables(db: Database):
-    database_url = db.url
-    if database_url.scheme in ["mysql", "mysql+aiomysql", "mysql+asyncmy"]:
-        url = str(database_url.replace(driver="pymysql"))
-    elif database_url.scheme in [
-        "postgresql+aiopg",
-        "sqlite+aiosqlite",
-        "postgresql+asyncpg",
-    ]:
-        url = str(database_url.replace(driver=None))
-    engine = sqlalchemy.create_engine(url)
-    Base.metadata.create_all(bind=engine)
+    KEY_DBS[key] = create_database(uri)
+    KEY_WRITERS[key] = DBWriter(KEY_DBS[key])
+    if read_uri:
+        KEY_READ_DBS[key] = create_database(read_uri)
+
+
+async def check_schema_version(db: Database):
+    try:
+        version = await db.fetch_val(select(func.max(schema_version_table.c.version)))
+    except Exception:
+        version = None
+    if (version or 0) < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"db: {db.url} schema version is {version or 0}, {SCHEMA_VERSION} is required, run `python -m openapi.migrations`")
+
 
 async def connect_db(key=None):
-    if key is None:
-        for db in KEY_DBS.values():
-            create_tables(db)
+    keys = list(KEY_DBS.keys()) if key is None else [key]
+    for key in keys:
+        for db in (KEY_DBS[key], KEY_READ_DBS.get(key)):
+            if db is None:
+                continue
             await db.connect()
-    else:
-        db = KEY_DBS[key]
-        create_tables(db)
-        await db.connect()
-        if "sqlite" in str(db.url):
-            await db.execute(
-                "PRAGMA journal_mode = WAL"
-            )
+            await check_schema_version(db)
+        KEY_WRITERS[key].start()
 
 
 async def disconnect_db(key=None):
-    if key is None:
-        for db in KEY_DBS.values():
-            await db.disconnect()
-    else:
+    keys = list(KEY_DBS.keys()) if key is None else [key]
+    for key in keys:
+        await KEY_WRITERS[key].stop()
         await KEY_DBS[key].disconnect()
+        if key in KEY_READ_DBS:
+            await KEY_READ_DBS[key].disconnect()
 
 
+# a schema change also needs a migration in openapi/migrations.py
 @as_declarative()
 class Base:
     id: Any
@@ -74,26 +109,38 @@ class Base:
 
 
 class Asset(Base):
-    coin_id = Column(BINARY(32), primary_key=True)
+    coin_id = Column(BYTES32, primary_key=True)
     asset_type = Column(String(16), nullable=False, doc='did/nft')
-    asset_id = Column(BINARY(32), nullable=False)
+    asset_id = Column(BYTES32, nullable=False)
     confirmed_height = Column(Integer, nullable=False, server_default='0')
     spent_height = Column(Integer, index=True, nullable=False, server_default='0') # spent record can be deleted
     coin = Column(JSON, nullable=False)
     lineage_proof = Column(JSON, nullable=False)
-    p2_puzzle_hash = Column(BINARY(32), nullable=False, index=True)
-    nft_did_id = Column(BINARY(32), nullable=True, doc='for nft')
+    p2_puzzle_hash = Column(BYTES32, nullable=False, index=True)
+    nft_did_id = Column(BYTES32, nullable=True, doc='for nft')
     curried_params = Column(JSON, nullable=False, doc='for recurry')
 
+    __table_args__ = (
+        # for keyset pagination of get_assets
+        Index('ix_asset_p2_type_spent_confirmed_coin', 'p2_puzzle_hash', 'asset_type', 'spent_height', 'confirmed_height', 'coin_id'),
+        # partial indexes only hold unspent rows where the backend supports it (sqlite / postgresql),
+        # get_assets compares spent_height with a literal 0 so that sqlite can match them
+        Index('ix_asset_p2_type_asset_id_confirmed_unspent', 'p2_puzzle_hash', 'asset_type', 'asset_id', 'confirmed_height', 'coin_id',
+              sqlite_where=text('spent_height = 0'), postgresql_where=text('spent_height = 0')),
+        Index('ix_asset_did_type_confirmed_unspent', 'nft_did_id', 'asset_type', 'confirmed_height', 'coin_id',
+              sqlite_where=text('spent_height = 0'), postgresql_where=text('spent_height = 0')),
+        Index('ix_asset_asset_id', 'asset_id'),
+    )
+
 
 class SingletonSpend(Base):
-    singleton_id = Column(BINARY(32), primary_key=True)
-    coin_id = Column(BINARY(32), nullable=False)
+    singleton_id = Column(BYTES32, primary_key=True)
+    coin_id = Column(BYTES32, nullable=False)
     spent_block_index = Column(Integer, nullable=False, server_default='0')
 
 
 class NftMetadata(Base):
-    hash = Column(BINARY(32), primary_key=True, doc='sha256')
+    hash = Column(BYTES32, primary_key=True, doc='sha256')
     format = Column(String(32), nullable=False, server_default='')
     name = Column(String(256), nullable=False, server_default='')
     collection_id = Column(String(256), nullable=False, server_default='')
@@ -102,23 +149,76 @@ class NftMetadata(Base):
 
 
 class Block(Base):
-    hash = Column(BINARY(32), primary_key=True)
+    hash = Column(BYTES32, primary_key=True)
     height = Column(Integer, unique=True, nullable=False)
     timestamp = Column(Integer, nullable=False)
-    prev_hash = Column(BINARY(32), nullable=False)
+    prev_hash = Column(BYTES32, nullable=False)
     is_tx = Column(Boolean, nullable=False)
 
 
 class AddressSync(Base):
     __tablename__ = 'address_sync'
-    address = Column(BINARY(32), primary_key=True)
+    address = Column(BYTES32, primary_key=True)
     height = Column(Integer, nullable=False, server_default='0')
 
 
+class CoinRecord(Base):
+    __tablename__ = 'coin_record'
+    coin_id = Column(BYTES32, primary_key=True)
+    puzzle_hash = Column(BYTES32, nullable=False, index=True)
+    coin = Column(JSON, nullable=False)
+    confirmed_height = Column(Integer, nullable=False, index=True)
+    spent_height = Column(Integer, index=True, nullable=False, server_default='0')
+
+
+class Balance(Base):
+    puzzle_hash = Column(BYTES32, primary_key=True)
+    amount = Column(String(32), nullable=False, server_default='0', doc='decimal string, can exceed int64')
+    coin_num = Column(Integer, nullable=False, server_default='0')
+    last_height = Column(Integer, nullable=False, server_default='0')
+
+
+class ChainState(Base):
+    __tablename__ = 'chain_state'
+    key = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+COIN_INDEX_START_HEIGHT = 'coin_index_start_height'
+
+
+def upsert(db: Database, model, values):
+    """
+    insert, or update the other columns on a primary key conflict.
+    values: a dict or a list of dicts with the same keys
+    """
+    table = model.__table__
+    first = values[0] if isinstance(values, list) else values
+    dialect = db.url.dialect
+    if dialect == 'mysql':
+        sql = mysql.insert(table).values(values)
+        return sql.on_duplicate_key_update({
+            k: sql.inserted[k] for k in first if not table.c[k].primary_key})
+    if dialect == 'postgresql':
+        sql = postgresql.insert(table).values(values)
+    elif dialect == 'sqlite':
+        sql = sqlite.insert(table).values(values)
+    else:
+        raise ValueError(f"db: upsert is not supported by {dialect}")
+    return sql.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={k: sql.excluded[k] for k in first if not table.c[k].primary_key},
+    )
+
+
 def get_assets(db: Database, asset_type: Optional[str]=None, asset_id: Optional[bytes]=None, p2_puzzle_hash: Optional[bytes]=None, 
     nft_did_id: Optional[bytes]=None, include_spent_coins=False,
-    start_height: Optional[int]=None, offset: Optional[int]=None, limit: Optional[int]=None) -> List[Asset]:
-    query = select(Asset).order_by(Asset.confirmed_height.asc())
+    start_height: Optional[int]=None, offset: Optional[int]=None, limit: Optional[int]=None,
+    cursor: Optional[Tuple[int, bytes]]=None) -> List[Asset]:
+    """
+    cursor: (confirmed_height, coin_id) of the last asset of the previous page
+    """
+    query = select(Asset).order_by(Asset.confirmed_height.asc(), Asset.coin_id.asc())
     if asset_type:
         query = query.where(Asset.asset_type == asset_type)
     if p2_puzzle_hash:
@@ -126,11 +226,15 @@ def get_assets(db: Database, asset_type: Optional[str]=None, asset_id: Optional[
     if nft_did_id:
         query = query.where(Asset.nft_did_id == nft_did_id)
     if not include_spent_coins:
-        query = query.where(Asset.spent_height == 0)
+        query = query.where(Asset.spent_height == literal_column('0'))
     if asset_id:
         query = query.where(Asset.asset_id == asset_id)
     if start_height:
         query = query.where(Asset.confirmed_height > start_height)
+    if cursor:
+        cursor_height, cursor_coin_id = cursor
+        # a row value comparison is a range on the index, an OR of the two cases is not
+        query = query.where(tuple_(Asset.confirmed_height, Asset.coin_id) > tuple_(cursor_height, cursor_coin_id))
     if offset:
         query = query.offset(offset)
     if limit:
@@ -152,7 +256,16 @@ async def update_asset_coin_spent_height(db: Database, coin_ids: List[bytes], sp
 
 async def save_asset(db: Database, asset: Asset):
     async with db.transaction():
-        return await db.execute(insert(Asset).values(asset.to_dict()).prefix_with('OR REPLACE'))
+        return await db.execute(upsert(db, Asset, asset.to_dict()))
+
+
+async def save_assets(db: Database, assets: List[Asset]):
+    chunk_size = 50
+    async with db.transaction():
+        for i in range(0, len(assets), chunk_size):
+            chunk = assets[i: i+chunk_size]
+            sql = upsert(db, Asset, [asset.to_dict() for asset in chunk])
+            await db.execute(sql)
 
 
 async def get_unspent_asset_coin_ids(db: Database, p2_puzzle_hash: Optional[bytes]=None):
@@ -172,7 +285,7 @@ async def get_nft_metadata_by_hash(db: Database, hash: bytes):
 
 async def save_metadata(db: Database, metadata: NftMetadata):
     async with db.transaction():
-        return await db.execute(insert(NftMetadata).values(metadata.to_dict()).prefix_with('OR REPLACE'))
+        return await db.execute(upsert(db, NftMetadata, metadata.to_dict()))
 
 
 async def get_metadata_by_hashes(db: Database, hashes: List[bytes]):
@@ -193,7 +306,7 @@ async def delete_singleton_spend_by_id(db: Database, singleton_id):
 
 async def save_singleton_spend(db: Database, item: SingletonSpend):
     async with db.transaction():
-        return await db.execute(insert(SingletonSpend).values(item.to_dict()).prefix_with('OR REPLACE'))
+        return await db.execute(upsert(db, SingletonSpend, item.to_dict()))
 
 
 
@@ -224,7 +337,7 @@ async def delete_block_after_height(db: Database, height):
 
 async def save_address_sync_height(db: Database, address: bytes, height: int):
     async with db.transaction():
-        return await db.execute(insert(AddressSync).values(address=address, height=height).prefix_with('OR REPLACE'))
+        return await db.execute(upsert(db, AddressSync, {'address': address, 'height': height}))
 
 
 async def get_address_sync_height(db: Database, address: bytes):
@@ -232,6 +345,153 @@ async def get_address_sync_height(db: Database, address: bytes):
     return await db.fetch_one(query)
 
 
+async def has_address_sync(db: Database) -> bool:
+    query = select(AddressSync.address).limit(1)
+    return await db.fetch_val(query) is not None
+
+
+async def get_synced_addresses(db: Database, addresses: List[bytes]) -> List[bytes]:
+    query = select(AddressSync.address).where(AddressSync.address.in_(addresses))
+    return [bytes(row.address) for row in await db.fetch_all(query)]
+
+
+async def advance_address_sync_height(db: Database, from_height: int, height: int):
+    """
+    addresses synced to from_height are moved to height, the assets between them are saved by the watcher
+    """
+    query = update(AddressSync)\
+        .where(AddressSync.height >= from_height)\
+        .where(AddressSync.height < height)\
+        .values(height=height)
+    async with db.transaction():
+        return await db.execute(query)
+
+
+async def get_chain_state(db: Database, key: str) -> Optional[int]:
+    query = select(ChainState.value).where(ChainState.key == key)
+    return await db.fetch_val(query)
+
+
+async def save_chain_state(db: Database, key: str, value: int):
+    async with db.transaction():
+        return await db.execute(upsert(db, ChainState, {'key': key, 'value': value}))
+
+
+async def save_coin_records(db: Database, coin_records: List[CoinRecord]):
+    chunk_size = 100
+    async with db.transaction():
+        for i in range(0, len(coin_records), chunk_size):
+            chunk = coin_records[i: i+chunk_size]
+            sql = upsert(db, CoinRecord, [cr.to_dict() for cr in chunk])
+            await db.execute(sql)
+
+
+async def update_coin_record_spent_height(db: Database, coin_ids: List[bytes], spent_height: int):
+    chunk_size = 200
+    async with db.transaction():
+        for i in range(0, len(coin_ids), chunk_size):
+            chunk_ids = coin_ids[i: i+chunk_size]
+            sql = update(CoinRecord)\
+            .where(CoinRecord.coin_id.in_(chunk_ids))\
+            .values(spent_height=spent_height)
+            await db.execute(sql)
+
+
+async def get_unspent_coin_records(db: Database, puzzle_hashes: List[bytes], max_height: Optional[int] = None) -> List[CoinRecord]:
+    chunk_size = 200
+    rows = []
+    for i in range(0, len(puzzle_hashes), chunk_size):
+        chunk_phs = puzzle_hashes[i: i+chunk_size]
+        query = select(CoinRecord)\
+            .where(CoinRecord.puzzle_hash.in_(chunk_phs))\
+            .where(CoinRecord.spent_height == 0)\
+            .order_by(CoinRecord.confirmed_height.asc())
+        if max_height is not None:
+            query = query.where(CoinRecord.confirmed_height <= max_height)
+        rows.extend(await db.fetch_all(query))
+    return rows
+
+
+async def get_balances(db: Database, puzzle_hashes: List[bytes]) -> List[Balance]:
+    query = select(Balance).where(Balance.puzzle_hash.in_(puzzle_hashes))
+    return await db.fetch_all(query)
+
+
+async def update_balances(db: Database, changes: Dict[bytes, Tuple[int, int]], height: int):
+    """
+    changes: puzzle_hash -> (amount delta, coin_num delta)
+    """
+    puzzle_hashes = list(changes.keys())
+    chunk_size = 200
+    async with db.transaction():
+        for i in range(0, len(puzzle_hashes), chunk_size):
+            chunk_phs = puzzle_hashes[i: i+chunk_size]
+            balances = {}
+            for row in await db.fetch_all(select(Balance).where(Balance.puzzle_hash.in_(chunk_phs))):
+                balances[bytes(row['puzzle_hash'])] = (int(row['amount']), row['coin_num'])
+
+            new_rows = []
+            empty_phs = []
+            for ph in chunk_phs:
+                amount, coin_num = balances.get(ph, (0, 0))
+                amount += changes[ph][0]
+                coin_num += changes[ph][1]
+                if coin_num <= 0:
+                    empty_phs.append(ph)
+                else:
+                    new_rows.append({'puzzle_hash': ph, 'amount': str(amount), 'coin_num': coin_num, 'last_height': height})
+            if new_rows:
+                await db.execute(upsert(db, Balance, new_rows))
+            if empty_phs:
+                await db.execute(delete(Balance).where(Balance.puzzle_hash.in_(empty_phs)))
+
+
+async def get_coin_index_range(db: Database) -> Tuple[Optional[int], Optional[int]]:
+    """
+    the coin index has every coin confirmed in [start_height, end_height],
+    end_height is start_height - 1 when no block has been indexed yet
+    """
+    start_height = await get_chain_state(db, COIN_INDEX_START_HEIGHT)
+    if start_height is None:
+        return None, None
+    end_height = await db.fetch_val(select(func.max(Block.height)))
+    if end_height is None or end_height < start_height:
+        end_height = start_height - 1
+    return start_height, end_height
+
+
+def read_snapshot(db: Database):
+    """
+    a transaction whose reads all see the same committed state,
+    it is the default for sqlite and mysql (repeatable read), postgresql needs repeatable read
+    """
+    if db.url.dialect == 'postgresql':
+        return db.transaction(isolation='repeatable_read', readonly=True)
+    return db.transaction()
+
+
+async def get_indexed_unspent_coin_records(db: Database, puzzle_hashes: List[bytes]) -> Tuple[Optional[int], Optional[int], List[CoinRecord]]:
+    """
+    the coin index range and the unspent coin records in it, read from one snapshot
+    """
+    async with read_snapshot(db):
+        start_height, end_height = await get_coin_index_range(db)
+        if start_height is None:
+            return None, None, []
+        return start_height, end_height, await get_unspent_coin_records(db, puzzle_hashes, max_height=end_height)
+
+
+async def get_indexed_balances(db: Database, puzzle_hashes: List[bytes]) -> Tuple[Optional[int], Optional[int], List[Balance]]:
+    """
+    the coin index range and the balances of the coins in it, read from one snapshot
+    """
+    async with read_snapshot(db):
+        start_height, end_height = await get_coin_index_range(db)
+        if start_height is None:
+            return None, None, []
+        return start_height, end_height, await get_balances(db, puzzle_hashes)
+
+
 async def reorg(db: Database, block_height: int):
     # block_height is correct, +1 is error
     async with db.transaction():
@@ -244,5 +504,35 @@ async def reorg(db: Database, block_height: int):
         # update address sync height
         await db.execute(update(AddressSync).where(AddressSync.height > block_height).values(height=block_height))
 
+        # rollback balances, coins created after block_height are removed
+        # and coins spent after block_height become unspent
+        changes = defaultdict(lambda: [0, 0])
+        query = select(CoinRecord.puzzle_hash, CoinRecord.coin)\
+            .where(CoinRecord.confirmed_height > block_height)\
+            .where(CoinRecord.spent_height == 0)
+        for row in await db.fetch_all(query):
+            change = changes[bytes(row['puzzle_hash'])]
+            change[0] -= row['coin']['amount']
+            change[1] -= 1
+        query = select(CoinRecord.puzzle_hash, CoinRecord.coin)\
+            .where(CoinRecord.confirmed_height <= block_height)\
+            .where(CoinRecord.spent_height > block_height)
+        for row in await db.fetch_all(query):
+            change = changes[bytes(row['puzzle_hash'])]
+            change[0] += row['coin']['amount']
+            change[1] += 1
+        if changes:
+            await update_balances(db, changes, block_height)
+
+        # rollback coin index
+        await db.execute(delete(CoinRecord).where(CoinRecord.confirmed_height > block_height))
+        await db.execute(update(CoinRecord).where(CoinRecord.spent_height > block_height).values(spent_height=0))
+        await db.execute(
+            update(ChainState)
+            .where(ChainState.key == COIN_INDEX_START_HEIGHT)
+            .where(ChainState.value > block_height + 1)
+            .values(value=block_height + 1)
+        )
+
         # delete block > block_height
         await db.execute(delete(Block).where(Block.height > block_height))
\ No newline at end of file
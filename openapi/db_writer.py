@@ -0,0 +1,59 @@
+"""
+a single writer task per database in the api process, its cache writes wait in a queue here
+instead of contending with each other and the watcher for the database write lock
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional, Tuple
+from databases import Database
+
+
+logger = logging.getLogger(__name__)
+
+
+class DBWriter:
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.queue: asyncio.Queue[Tuple[Callable[[Database], Awaitable], asyncio.Future]] = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.worker())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        while not self.queue.empty():
+            _, fut = self.queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("db writer is stopped"))
+
+    async def run(self, write: Callable[[Database], Awaitable]) -> Any:
+        """
+        queue write(db) and wait for its result, writes run one at a time in the order they are queued
+        """
+        if self.task is None:
+            raise RuntimeError("db writer is not started")
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((write, fut))
+        return await fut
+
+    async def worker(self):
+        while True:
+            write, fut = await self.queue.get()
+            if fut.done():
+                # the caller is cancelled
+                continue
+            try:
+                result = await write(self.db)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
@@ -2,7 +2,7 @@ import json
 import asyncio
 from aiocache import caches
 from typing import Dict
-from .types import Program, Coin, LineageProof
+from .types import Program, Coin, CoinSpend, LineageProof
 from .puzzles import (
     SINGLETON_TOP_LAYER_MOD, SINGLETON_TOP_LAYER_MOD_HASH,
     SINGLETON_LAUNCHER_MOD_HASH,
@@ -44,25 +44,19 @@ def program_to_metadata(program: Program) -> Dict:
     return metadata
 
 
-def get_did_info_from_coin_spend(coin: Coin, parent_cs: dict, address: bytes):
-    parent_coin = Coin.from_json_dict(parent_cs['coin'])
-    puzzle = Program.fromhex(parent_cs['puzzle_reveal'])
-
+def get_did_info(coin: Coin, parent_cs: CoinSpend, singleton_inner_puzzle: Program, curried_args_pz: Program, address: bytes):
+    """
+    singleton_inner_puzzle is the did inner puzzle and curried_args_pz are its curried arguments
+    """
+    parent_coin = parent_cs.coin
     try:
-        mod, curried_args_pz = puzzle.uncurry()
-        if mod != SINGLETON_TOP_LAYER_MOD:
-            return
-        singleton_inner_puzzle = curried_args_pz.rest().first()
-        mod, curried_args_pz = singleton_inner_puzzle.uncurry()
-        if mod != DID_INNERPUZ_MOD:
-            return
         curried_args = curried_args_pz.as_iter()
+        p2_puzzle, recovery_list_hash, num_verification, singleton_struct, metadata = curried_args
     except Exception:
-        return 
+        return
 
-    solution = Program.fromhex(parent_cs['solution'])
+    solution = parent_cs.solution
 
-    p2_puzzle, recovery_list_hash, num_verification, singleton_struct, metadata = curried_args
     recovery_list_hash = recovery_list_hash.as_atom()
 
     p2_puzzle_hash = p2_puzzle.get_tree_hash()
@@ -0,0 +1,201 @@
+"""
+versioned schema migrations, run them out of band before starting the api and the watcher:
+
+    python -m openapi.migrations [--networks mainnet]
+
+each migration has its own frozen table definitions, so it keeps working after the models in db.py change.
+tables and indexes are created with checkfirst, databases created by the old create_all at connect time
+are upgraded in place.
+"""
+import argparse
+import logging
+from typing import Callable, List, Tuple
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, BINARY, JSON, Boolean, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.dialects import postgresql
+from databases import DatabaseURL
+
+
+logger = logging.getLogger(__name__)
+
+# postgresql has no BINARY type
+BYTES32 = BINARY(32).with_variant(postgresql.BYTEA(), 'postgresql')
+
+
+def create_all(conn: Connection, metadata: MetaData):
+    for table in metadata.sorted_tables:
+        table.create(conn, checkfirst=True)
+        # an existing table may miss some of its indexes
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def v1_initial_tables(conn: Connection):
+    metadata = MetaData()
+    Table(
+        'asset', metadata,
+        Column('coin_id', BYTES32, primary_key=True),
+        Column('asset_type', String(16), nullable=False),
+        Column('asset_id', BYTES32, nullable=False),
+        Column('confirmed_height', Integer, nullable=False, server_default='0'),
+        Column('spent_height', Integer, index=True, nullable=False, server_default='0'),
+        Column('coin', JSON, nullable=False),
+        Column('lineage_proof', JSON, nullable=False),
+        Column('p2_puzzle_hash', BYTES32, nullable=False, index=True),
+        Column('nft_did_id', BYTES32, nullable=True),
+        Column('curried_params', JSON, nullable=False),
+    )
+    Table(
+        'singletonspend', metadata,
+        Column('singleton_id', BYTES32, primary_key=True),
+        Column('coin_id', BYTES32, nullable=False),
+        Column('spent_block_index', Integer, nullable=False, server_default='0'),
+    )
+    Table(
+        'nftmetadata', metadata,
+        Column('hash', BYTES32, primary_key=True),
+        Column('format', String(32), nullable=False, server_default=''),
+        Column('name', String(256), nullable=False, server_default=''),
+        Column('collection_id', String(256), nullable=False, server_default=''),
+        Column('collection_name', String(256), nullable=False, server_default=''),
+        Column('full_data', JSON, nullable=False),
+    )
+    Table(
+        'block', metadata,
+        Column('hash', BYTES32, primary_key=True),
+        Column('height', Integer, unique=True, nullable=False),
+        Column('timestamp', Integer, nullable=False),
+        Column('prev_hash', BYTES32, nullable=False),
+        Column('is_tx', Boolean, nullable=False),
+    )
+    Table(
+        'address_sync', metadata,
+        Column('address', BYTES32, primary_key=True),
+        Column('height', Integer, nullable=False, server_default='0'),
+    )
+    create_all(conn, metadata)
+
+
+def v2_coin_index_tables(conn: Connection):
+    metadata = MetaData()
+    Table(
+        'coin_record', metadata,
+        Column('coin_id', BYTES32, primary_key=True),
+        Column('puzzle_hash', BYTES32, nullable=False, index=True),
+        Column('coin', JSON, nullable=False),
+        Column('confirmed_height', Integer, nullable=False, index=True),
+        Column('spent_height', Integer, index=True, nullable=False, server_default='0'),
+    )
+    Table(
+        'balance', metadata,
+        Column('puzzle_hash', BYTES32, primary_key=True),
+        Column('amount', String(32), nullable=False, server_default='0'),
+        Column('coin_num', Integer, nullable=False, server_default='0'),
+        Column('last_height', Integer, nullable=False, server_default='0'),
+    )
+    Table(
+        'chain_state', metadata,
+        Column('key', String(64), primary_key=True),
+        Column('value', Integer, nullable=False),
+    )
+    create_all(conn, metadata)
+
+
+def v3_asset_indexes(conn: Connection):
+    asset = Table('asset', MetaData(), autoload_with=conn)
+    c = asset.c
+    indexes = [
+        Index('ix_asset_p2_type_spent_confirmed_coin',
+              c.p2_puzzle_hash, c.asset_type, c.spent_height, c.confirmed_height, c.coin_id),
+        Index('ix_asset_p2_type_asset_id_unspent', c.p2_puzzle_hash, c.asset_type, c.asset_id,
+              sqlite_where=text('spent_height = 0'), postgresql_where=text('spent_height = 0')),
+        Index('ix_asset_did_type_confirmed_unspent', c.nft_did_id, c.asset_type, c.confirmed_height, c.coin_id,
+              sqlite_where=text('spent_height = 0'), postgresql_where=text('spent_height = 0')),
+        Index('ix_asset_asset_id', c.asset_id),
+    ]
+    for index in indexes:
+        index.create(conn, checkfirst=True)
+
+
+def v4_asset_id_ordered_index(conn: Connection):
+    # the planner preferred the p2 / type index ordered by confirmed_height over the one without the order columns
+    asset = Table('asset', MetaData(), autoload_with=conn)
+    c = asset.c
+    Index('ix_asset_p2_type_asset_id_unspent', c.p2_puzzle_hash, c.asset_type, c.asset_id).drop(conn, checkfirst=True)
+    Index('ix_asset_p2_type_asset_id_confirmed_unspent',
+          c.p2_puzzle_hash, c.asset_type, c.asset_id, c.confirmed_height, c.coin_id,
+          sqlite_where=text('spent_height = 0'), postgresql_where=text('spent_height = 0')).create(conn, checkfirst=True)
+
+
+# append only, the position + 1 is the version
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ('initial tables', v1_initial_tables),
+    ('coin index tables', v2_coin_index_tables),
+    ('asset query indexes', v3_asset_indexes),
+    ('asset id index ordered by confirmed height', v4_asset_id_ordered_index),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+version_metadata = MetaData()
+schema_version_table = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+)
+
+
+def to_sync_url(uri: str) -> str:
+    database_url = DatabaseURL(uri)
+    if database_url.scheme in ["mysql", "mysql+aiomysql", "mysql+asyncmy"]:
+        return str(database_url.replace(driver="pymysql"))
+    elif database_url.scheme in [
+        "postgresql+aiopg",
+        "sqlite+aiosqlite",
+        "postgresql+asyncpg",
+    ]:
+        return str(database_url.replace(driver=None))
+    return uri
+
+
+def get_version(conn: Connection) -> int:
+    schema_version_table.create(conn, checkfirst=True)
+    return conn.execute(sqlalchemy.select(sqlalchemy.func.max(schema_version_table.c.version))).scalar() or 0
+
+
+def migrate(uri: str) -> int:
+    engine = sqlalchemy.create_engine(to_sync_url(uri))
+    try:
+        with engine.begin() as conn:
+            version = get_version(conn)
+        for i, (name, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("%s: migrate to version %d, %s", uri, i, name)
+            # one transaction per migration, a failed migration can be rerun
+            with engine.begin() as conn:
+                migration(conn)
+                conn.execute(schema_version_table.insert().values(version=i))
+            version = i
+    finally:
+        engine.dispose()
+    return version
+
+
+def main(networks: List[str] = None):
+    from .config import settings
+    for row in settings.SUPPORTED_CHAINS.values():
+        if networks is None:
+            if row.get('enable') == False:
+                continue
+        else:
+            if row['network_name'] not in networks:
+                continue
+        version = migrate(row['database_uri'])
+        print(f"{row['network_name']}: schema version {version}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--networks', nargs='+', help='networks to migrate, default is the enabled networks')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    main(args.networks)
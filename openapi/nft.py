@@ -7,8 +7,8 @@ import dataclasses
 from dataclasses import dataclass
 from clvm.casts import int_from_bytes
 
-from .puzzles import SINGLETON_TOP_LAYER_MOD, NFT_STATE_LAYER_MOD, NFT_OWNERSHIP_LAYER
-from .types import Coin, Program, LineageProof
+from .puzzles import NFT_OWNERSHIP_LAYER
+from .types import Coin, CoinSpend, Program, LineageProof
 
 
 logger = logging.getLogger(__name__)
@@ -17,7 +17,6 @@ logger = logging.getLogger(__name__)
 _T_UncurriedNFT = TypeVar("_T_UncurriedNFT", bound="UncurriedNFT")
 
 
-NFT_MOD = NFT_STATE_LAYER_MOD
 bytes32 = bytes
 uint16 = int
 
@@ -26,7 +25,7 @@ uint16 = int
 class UncurriedNFT:
     """
     A simple solution for uncurry NFT puzzle.
-    Initial the class with a full NFT puzzle, it will do a deep uncurry.
+    Built by the singleton classifier from a singleton whose inner puzzle is the NFT state layer.
     This is the only place you need to change after modified the Chialisp curried parameters.
     """
 
@@ -90,27 +89,21 @@ class UncurriedNFT:
     trade_price_percentage: Optional[uint16]
 
     @classmethod
-    def uncurry(cls, puzzle: Program) -> "UncurriedNFT":
+    def from_nft_state_layer(cls, singleton_struct: Program, nft_state_layer: Program, curried_args: Program) -> "UncurriedNFT":
         """
-        Try to uncurry a NFT puzzle
-        :param cls UncurriedNFT class
-        :param puzzle: Puzzle program
+        Build from a singleton whose inner puzzle is already uncurried as the NFT state layer
+        :param singleton_struct: Curried singleton struct of the singleton top layer
+        :param nft_state_layer: Inner puzzle of the singleton top layer
+        :param curried_args: Curried arguments of the NFT state layer
         :return Uncurried NFT
         """
-        mod, curried_args = puzzle.uncurry()
-        if mod != SINGLETON_TOP_LAYER_MOD:
-            raise ValueError(f"Cannot uncurry NFT puzzle, failed on singleton top layer {mod.get_tree_hash().hex()}")
         try:
-            (singleton_struct, nft_state_layer) = curried_args.as_iter()
             singleton_mod_hash = singleton_struct.first()
             singleton_launcher_id = singleton_struct.rest().first()
             launcher_puzhash = singleton_struct.rest().rest()
         except ValueError as e:
-            raise ValueError(f"Cannot uncurry singleton top layer: Args {curried_args}") from e
+            raise ValueError(f"Cannot uncurry singleton struct: {singleton_struct}") from e
 
-        mod, curried_args = curried_args.rest().first().uncurry()
-        if mod != NFT_MOD:
-            raise ValueError(f"Cannot uncurry NFT puzzle, failed on NFT state layer")
         try:
             # Set nft parameters
             nft_mod_hash, metadata, metadata_updater_hash, inner_puzzle = curried_args.as_iter()
@@ -253,8 +246,19 @@ def update_metadata(metadata: Program, update_condition: Program) -> Program:
     return metadata_to_program(new_metadata)
 
 
-def get_metadata_and_phs(unft: UncurriedNFT, solution: Program) -> Tuple[Program, bytes32]:
-    conditions = unft.p2_puzzle.run(unft.get_innermost_solution(solution))
+def get_p2_conditions(unft: UncurriedNFT, solution: Program) -> Program:
+    """
+    Run the p2 puzzle of the NFT, the most expensive step of decoding a NFT spend
+    :param unft: Uncurried NFT
+    :param solution: Full solution of the NFT spend
+    :return: Conditions created by the p2 puzzle
+    """
+    return unft.p2_puzzle.run(unft.get_innermost_solution(solution))
+
+
+def get_metadata_and_phs(unft: UncurriedNFT, solution: Program, conditions: Optional[Program] = None) -> Tuple[Program, bytes32]:
+    if conditions is None:
+        conditions = get_p2_conditions(unft, solution)
     metadata = unft.metadata
     puzhash_for_derivation: Optional[bytes32] = None
     for condition in conditions.as_iter():
@@ -276,8 +280,9 @@ def get_metadata_and_phs(unft: UncurriedNFT, solution: Program) -> Tuple[Program
     return metadata, puzhash_for_derivation
 
 
-def get_new_owner_did(unft: UncurriedNFT, solution: Program) -> Optional[bytes32]:
-    conditions = unft.p2_puzzle.run(unft.get_innermost_solution(solution))
+def get_new_owner_did(unft: UncurriedNFT, solution: Program, conditions: Optional[Program] = None) -> Optional[bytes32]:
+    if conditions is None:
+        conditions = get_p2_conditions(unft, solution)
     new_did_id = None
     for condition in conditions.as_iter():
         if condition.first().as_int() == -10:
@@ -286,35 +291,33 @@ def get_new_owner_did(unft: UncurriedNFT, solution: Program) -> Optional[bytes32
     return new_did_id
  
 
-def get_nft_info_from_coin_spend(nft_coin: Coin, parent_cs: dict, address: bytes):
-    puzzle = Program.fromhex(parent_cs['puzzle_reveal'])
-    try:
-        uncurried_nft = UncurriedNFT.uncurry(puzzle)
-    except Exception as e:
-        logger.debug('uncurry nft puzzle: %r', e)
-        return
-    solution = Program.fromhex(parent_cs['solution'])
+def get_nft_info(nft_coin: Coin, parent_cs: CoinSpend, uncurried_nft: UncurriedNFT, address: bytes):
+    solution = parent_cs.solution
     
+    # the conditions are shared by the metadata, destination and owner DID lookups
+    conditions = get_p2_conditions(uncurried_nft, solution)
+
     # DID ID determines which NFT wallet should process the NFT
     new_did_id = None
     old_did_id = None
     # P2 puzzle hash determines if we should ignore the NFT
-    old_p2_puzhash = uncurried_nft.p2_puzzle.get_tree_hash()
     metadata, new_p2_puzhash = get_metadata_and_phs(
         uncurried_nft,
         solution,
+        conditions,
     )
+    if new_p2_puzhash != address:
+        return
+
     if uncurried_nft.supports_did:
-        new_did_id = get_new_owner_did(uncurried_nft, solution)
+        new_did_id = get_new_owner_did(uncurried_nft, solution, conditions)
         old_did_id = uncurried_nft.owner_did
         if new_did_id is None:
             new_did_id = old_did_id
         if new_did_id == b"":
             new_did_id = None
 
-    if new_p2_puzhash != address:
-        return
-    parent_coin = Coin.from_json_dict(parent_cs['coin'])
+    parent_coin = parent_cs.coin
     lineage_proof = LineageProof(parent_coin.parent_coin_info, uncurried_nft.nft_state_layer.get_tree_hash(), parent_coin.amount)
     return (uncurried_nft, new_did_id, new_p2_puzhash, lineage_proof)
 
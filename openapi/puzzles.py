@@ -84,7 +84,9 @@ SINGLETON_TOP_LAYER_MOD_HASH = SINGLETON_TOP_LAYER_MOD.get_tree_hash()
 SINGLETON_LAUNCHER_MOD = load_clvm("singleton_launcher.clvm")
 SINGLETON_LAUNCHER_MOD_HASH = SINGLETON_LAUNCHER_MOD.get_tree_hash()
 NFT_STATE_LAYER_MOD = load_clvm("nft_state_layer.clvm")
+NFT_STATE_LAYER_MOD_HASH = NFT_STATE_LAYER_MOD.get_tree_hash()
 NFT_METADATA_UPDATER = load_clvm("nft_metadata_updater_default.clvm")
 NFT_OWNERSHIP_LAYER = load_clvm("nft_ownership_layer.clvm")
 NFT_TRANSFER_PROGRAM_DEFAULT = load_clvm("nft_ownership_transfer_program_one_way_claim_with_royalties.clvm")
-DID_INNERPUZ_MOD = load_clvm("did_innerpuz.clvm")
\ No newline at end of file
+DID_INNERPUZ_MOD = load_clvm("did_innerpuz.clvm")
+DID_INNERPUZ_MOD_HASH = DID_INNERPUZ_MOD.get_tree_hash()
\ No newline at end of file
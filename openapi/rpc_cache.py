@@ -0,0 +1,71 @@
+"""
+cache of full node rpc results that never change, used by FullNodeRpcClient.cached_fetch
+"""
+import json
+import logging
+from typing import Any, Dict, Optional
+from aiocache import caches
+from .utils.lru_cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(path: str, request_json: Optional[Dict]) -> str:
+    return f"{path}:{json.dumps(request_json, sort_keys=True)}"
+
+
+class RpcResponseCache:
+    """
+    backend:
+    - memory: a LRU of `size` results in the process
+    - aiocache: the aiocache alias (the CACHE section of settings.toml), entries expire after `ttl` seconds,
+                the backend bounds its own size
+    confirmations: results at a height are only stored once the height is this many blocks below the peak
+    """
+
+    def __init__(self, backend: str = 'memory', size: int = 10000, confirmations: int = 32,
+                 ttl: Optional[int] = 86400, alias: str = 'default'):
+        self.backend = backend
+        self.confirmations = confirmations
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if backend == 'memory':
+            self.lru = LRUCache(size)
+        elif backend == 'aiocache':
+            self.cache = caches.create(
+                alias, namespace='rpc:', serializer={'class': 'aiocache.serializers.JsonSerializer'})
+        else:
+            raise ValueError(f"unknown rpc response cache backend: {backend}")
+
+    async def get(self, key: str) -> Optional[Any]:
+        if self.backend == 'memory':
+            value = self.lru.get(key)
+        else:
+            try:
+                value = await self.cache.get(key)
+            except Exception as e:
+                # the rpc still works without the cache
+                logger.warning("rpc response cache get error: %r", e)
+                value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def put(self, key: str, value: Any):
+        if self.backend == 'memory':
+            self.lru.put(key, value)
+            return
+        try:
+            await self.cache.set(key, value, ttl=self.ttl)
+        except Exception as e:
+            logger.warning("rpc response cache set error: %r", e)
+
+    def stats(self) -> Dict[str, int]:
+        stats = {'hits': self.hits, 'misses': self.misses}
+        if self.backend == 'memory':
+            stats['size'] = len(self.lru)
+        return stats
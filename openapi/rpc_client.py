@@ -1,15 +1,22 @@
 import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
 from pathlib import Path
 from urllib.parse import urljoin
 import ssl
 from ssl import SSLContext
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Set, Union
 import yaml
 import aiohttp
 from .utils.singleflight import SingleFlight
+from .rpc_cache import RpcResponseCache, request_key
 
 bytes32 = bytes
 
+logger = logging.getLogger(__name__)
+
 
 def ssl_context_for_client(
     ca_cert: Path,
@@ -26,17 +33,112 @@ def ssl_context_for_client(
     return ssl_context
 
 
+class CircuitOpenError(aiohttp.ClientConnectionError):
+    """
+    the node failed too many times in a row, requests fail fast until the breaker resets
+    """
+
+
+def is_node_failure(e: Exception) -> bool:
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
 class FullNodeRpcClient:
     url: str
-    session: aiohttp.ClientSession
+    sessions: List[aiohttp.ClientSession]
     closing_task: Optional[asyncio.Task]
     ssl_context: Optional[SSLContext]
 
+    POLICY_OPTIONS = ('timeout', 'method_timeouts', 'retries', 'method_retries', 'backoff', 'max_backoff',
+                      'breaker_failures', 'breaker_reset')
+
     def __init__(self):
         self.sf = SingleFlight()
-        
+        self.sessions = []
+        self.session_index = 0
+        # path -> full url, joined once
+        self.urls: Dict[str, str] = {}
+        self.requests = 0
+        self.in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.configure_policy()
+        # highest peak seen by get_blockchain_state, refreshed for the response cache when older than peak_max_age
+        self.peak_height: Optional[int] = None
+        self.peak_time = 0.0
+        self.peak_max_age = 60
+        self.response_cache: Optional[RpcResponseCache] = None
+
+    def configure_policy(self, timeout: float = 30, method_timeouts: Optional[Dict[str, float]] = None,
+                         retries: int = 2, method_retries: Optional[Dict[str, int]] = None,
+                         backoff: float = 0.2, max_backoff: float = 2,
+                         breaker_failures: int = 5, breaker_reset: float = 10):
+        """
+        timeout: seconds of a request, method_timeouts overrides it by rpc method
+        retries: idempotent get_* methods are retried on connection errors, timeouts and 5xx,
+                 after a random delay up to min(max_backoff, backoff * 2 ** attempt),
+                 method_retries overrides it by rpc method
+        breaker_failures: after this many failures in a row, requests fail fast with CircuitOpenError
+                          until one probe request succeeds, probing at most every breaker_reset seconds
+        """
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.method_timeouts = {
+            method: aiohttp.ClientTimeout(total=seconds) for method, seconds in (method_timeouts or {}).items()}
+        self.retries = max(retries, 0)
+        self.method_retries = {method: max(n, 0) for method, n in (method_retries or {}).items()}
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_failures = max(breaker_failures, 1)
+        self.breaker_reset = breaker_reset
+        self.failures = 0
+        self.breaker_open_until = 0.0
+
+    def init_sessions(self, sessions: int = 1, limit_per_host: int = 100, keepalive_timeout: float = 60, ttl_dns_cache: int = 300):
+        """
+        sessions: requests are spread over the sessions round robin, each has its own connection pool
+        limit_per_host: max connections of one session, idle ones are kept alive for keepalive_timeout seconds
+        aiohttp sets TCP_NODELAY on every connection
+        """
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        for _ in range(max(sessions, 1)):
+            connector = aiohttp.TCPConnector(
+                limit=limit_per_host,
+                limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=ttl_dns_cache,
+                ssl=self.ssl_context or True,
+            )
+            self.sessions.append(aiohttp.ClientSession(connector=connector, trace_configs=[trace_config]))
+
+    def init_options(self, **options):
+        self.init_response_cache(options.pop('response_cache', None))
+        self.configure_policy(**{k: options.pop(k) for k in self.POLICY_OPTIONS if k in options})
+        self.init_sessions(**options)
+
+    def init_response_cache(self, options: Optional[Dict] = None):
+        """
+        options: enable and the RpcResponseCache arguments, the cache is off by default
+        """
+        options = dict(options or {})
+        if options.pop('enable', False):
+            self.response_cache = RpcResponseCache(**options)
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
     @classmethod
-    async def create_by_chia_root_path(cls, chia_root_path):
+    async def create_by_chia_root_path(cls, chia_root_path, **options):
+        """
+        options: see configure_policy and init_sessions
+        """
         self = cls()
         root_path = Path(chia_root_path)
         config_path = Path(chia_root_path) / "config" / "config.yaml"
@@ -46,35 +148,141 @@ class FullNodeRpcClient:
         ca_key_path = root_path / config["private_ssl_ca"]["key"]
         private_cert_path = root_path / config["daemon_ssl"]["private_crt"]
         private_key_path = root_path / config["daemon_ssl"]["private_key"]
-        self.session = aiohttp.ClientSession()
         self.ssl_context = ssl_context_for_client(ca_cert_path, ca_key_path, private_cert_path, private_key_path)
+        self.init_options(**options)
         self.closing_task = None
         return self
     
     @classmethod
-    async def create_by_proxy_url(cls, proxy_url):
+    async def create_by_proxy_url(cls, proxy_url, **options):
+        """
+        options: see configure_policy and init_sessions
+        """
         self = cls()
         self.url = proxy_url
-        self.session = aiohttp.ClientSession()
         self.ssl_context = None
+        self.init_options(**options)
         self.closing_task = None
         return self
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        session = self.sessions[self.session_index]
+        self.session_index = (self.session_index + 1) % len(self.sessions)
+        return session
+
+    def get_url(self, path) -> str:
+        url = self.urls.get(path)
+        if url is None:
+            url = self.urls[path] = urljoin(self.url, path)
+        return url
+
+    def pool_stats(self) -> Dict[str, int]:
+        return {
+            'sessions': len(self.sessions),
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'failures': self.failures,
+            'circuit_open': self.failures >= self.breaker_failures,
+            **({'response_cache': self.response_cache.stats()} if self.response_cache else {}),
+        }
     
+    def check_breaker(self):
+        if self.failures < self.breaker_failures:
+            return
+        now = time.monotonic()
+        if now < self.breaker_open_until:
+            raise CircuitOpenError(f"rpc node {self.url} is unhealthy")
+        # let this request probe the node, the others keep failing fast
+        self.breaker_open_until = now + self.breaker_reset
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures == self.breaker_failures:
+            self.breaker_open_until = time.monotonic() + self.breaker_reset
+            logger.warning("rpc node %s circuit open", self.url)
+
+    async def post(self, path, request_json, raise_for_status: bool):
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            timeout = self.method_timeouts.get(path, self.timeout)
+            async with self.session.post(self.get_url(path), json=request_json, timeout=timeout) as response:
+                if raise_for_status:
+                    response.raise_for_status()
+                return await response.json()
+        finally:
+            self.in_flight -= 1
+
+    def retries_for(self, path) -> int:
+        if not path.startswith('get_'):
+            return 0
+        return self.method_retries.get(path, self.retries)
+
+    async def request(self, path, request_json, raise_for_status: bool = True):
+        retries = self.retries_for(path)
+        attempt = 0
+        while True:
+            self.check_breaker()
+            try:
+                res = await self.post(path, request_json, raise_for_status)
+            except Exception as e:
+                if not is_node_failure(e):
+                    raise
+                self.record_failure()
+                if attempt >= retries or self.failures >= self.breaker_failures:
+                    raise
+                attempt += 1
+                await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+            self.failures = 0
+            return res
+
     async def raw_fetch(self, path, request_json):
-        async with self.session.post(urljoin(self.url, path), json=request_json, ssl_context=self.ssl_context) as response:
-            res_json = await response.json()
-            return res_json
+        if path.startswith('get_'):
+            # identical idempotent requests in flight share one upstream call
+            return await self.sf.do('raw:' + request_key(path, request_json), lambda: self.raw_fetch_once(path, request_json))
+        return await self.raw_fetch_once(path, request_json)
+
+    async def raw_fetch_once(self, path, request_json):
+        return await self.request(path, request_json, raise_for_status=False)
 
     async def fetch(self, path, request_json) -> Any:
-        async with self.session.post(urljoin(self.url, path), json=request_json, ssl_context=self.ssl_context) as response:
-            response.raise_for_status()
-            res_json = await response.json()
-            if not res_json["success"]:
-                raise ValueError(res_json)
-            return res_json
+        if path.startswith('get_'):
+            return await self.sf.do(request_key(path, request_json), lambda: self.fetch_once(path, request_json))
+        return await self.fetch_once(path, request_json)
+
+    async def fetch_once(self, path, request_json) -> Any:
+        res_json = await self.request(path, request_json)
+        if not res_json["success"]:
+            raise ValueError(res_json)
+        return res_json
+
+    async def cached_fetch(self, path, request_json, height: Optional[int] = None) -> Any:
+        """
+        fetch an immutable result through the response cache,
+        height: the result is only cached once the height is deep enough
+        """
+        cache = self.response_cache
+        if cache is None:
+            return await self.fetch(path, request_json)
+        if height is not None:
+            if height > await self.get_peak_height(self.peak_max_age) - cache.confirmations:
+                return await self.fetch(path, request_json)
+        key = request_key(path, request_json)
+        res = await cache.get(key)
+        if res is None:
+            res = await self.fetch(path, request_json)
+            await cache.put(key, res)
+        return res
+
+    async def close_sessions(self):
+        await asyncio.gather(*[session.close() for session in self.sessions])
 
     def close(self):
-        self.closing_task = asyncio.create_task(self.session.close())
+        self.closing_task = asyncio.create_task(self.close_sessions())
 
     async def await_closed(self):
         if self.closing_task is not None:
@@ -85,12 +293,24 @@ class FullNodeRpcClient:
     
     async def get_blockchain_state(self):
         resp = await self.fetch("get_blockchain_state", {})
+        peak = resp['blockchain_state']['peak']
+        if peak:
+            self.peak_height = max(self.peak_height or 0, peak['height'])
+            self.peak_time = time.monotonic()
         return resp['blockchain_state']
 
     async def get_block_number(self):
-        resp = await self.sf.do('block_number', lambda: self.get_blockchain_state()) 
+        resp = await self.get_blockchain_state()
         return resp['peak']['height']
 
+    async def get_peak_height(self, max_age: float) -> int:
+        """
+        the highest peak seen, refreshed when it is older than max_age seconds
+        """
+        if self.peak_height is None or time.monotonic() - self.peak_time > max_age:
+            await self.get_block_number()
+        return self.peak_height
+
     async def get_coin_records_by_puzzle_hash(
         self,
         puzzle_hash: bytes32,
@@ -169,7 +389,7 @@ class FullNodeRpcClient:
 
 
     async def get_puzzle_and_solution(self, coin_id: bytes32, height: int):
-        response = await self.fetch("get_puzzle_and_solution", {"coin_id": coin_id.hex(), "height": height})
+        response = await self.cached_fetch("get_puzzle_and_solution", {"coin_id": coin_id.hex(), "height": height}, height)
         return response['coin_solution']
 
     async def get_coin_records_by_parent_ids(self, parent_ids: List[bytes32], include_spent_coins: bool = True,
@@ -185,13 +405,208 @@ class FullNodeRpcClient:
         return response['coin_records']
     
     async def get_block_record_by_height(self, height: int):
-        response = await self.fetch("get_block_record_by_height", {"height": height})
+        response = await self.cached_fetch("get_block_record_by_height", {"height": height}, height)
         return response['block_record']
     
-    async def get_additions_and_removals(self, header_hash: bytes32):
-        response = await self.fetch("get_additions_and_removals", {"header_hash": header_hash.hex()})
+    async def get_additions_and_removals(self, header_hash: bytes32, height: int):
+        response = await self.cached_fetch("get_additions_and_removals", {"header_hash": header_hash.hex()}, height)
         return response['additions'], response['removals']
 
+    async def get_block_spends(self, header_hash: bytes32, height: int):
+        response = await self.cached_fetch("get_block_spends", {"header_hash": header_hash.hex()}, height)
+        return response['block_spends']
+
     async def get_fee_estimate(self, target_times: Optional[List[int]], cost: Optional[int]):
         response = await self.fetch("get_fee_estimate", {"target_times": target_times, "cost": cost})
-        return response
\ No newline at end of file
+        return response
+
+
+@dataclass
+class NodeState:
+    client: FullNodeRpcClient
+    # ewma of the request seconds, None before the first response
+    latency: Optional[float] = None
+    in_flight: int = 0
+    peak_height: int = 0
+    synced: bool = False
+    # skipped after a connection error until this monotonic time
+    down_until: float = 0.0
+
+    @property
+    def load(self) -> float:
+        return (self.latency or 0) * (self.in_flight + 1)
+
+
+class MultiNodeRpcClient(FullNodeRpcClient):
+    """
+    - a request goes to the healthy node with the lowest latency ewma * (in-flight requests + 1),
+      and fails over to the next one on a connection error, the retries of the method are spent on other nodes,
+      a node is never retried by its own client
+    - a node is healthy when it is synced, at most max_height_lag blocks behind the highest peak,
+      and not cooling down after a connection error
+    - push_tx is sent to every synced node, and returns the first success
+    """
+    ewma_alpha = 0.2
+    down_seconds = 10
+    health_check_timeout = 5
+
+    def __init__(self):
+        super().__init__()
+        self.nodes: List[NodeState] = []
+        self.health_check_interval = 10
+        self.max_height_lag = 3
+        self.health_check_task: Optional[asyncio.Task] = None
+        self.push_tasks: Set[asyncio.Task] = set()
+
+    @classmethod
+    async def create(cls, urls_or_paths: List[str], health_check_interval: float = 10, max_height_lag: int = 3, **options):
+        self = cls()
+        # one cache for all nodes
+        self.init_response_cache(options.pop('response_cache', None))
+        policy = {k: options.pop(k) for k in self.POLICY_OPTIONS if k in options}
+        self.configure_policy(**policy)
+        options.update(policy, retries=0, method_retries=None)
+        for url_or_path in urls_or_paths:
+            if url_or_path.startswith('http'):
+                client = await FullNodeRpcClient.create_by_proxy_url(url_or_path, **options)
+            else:
+                client = await FullNodeRpcClient.create_by_chia_root_path(url_or_path, **options)
+            self.nodes.append(NodeState(client))
+        self.url = self.nodes[0].client.url
+        self.ssl_context = self.nodes[0].client.ssl_context
+        self.health_check_interval = health_check_interval
+        self.max_height_lag = max_height_lag
+        self.closing_task = None
+        await self.check_health()
+        self.health_check_task = asyncio.create_task(self.check_health_forever())
+        return self
+
+    def observe_latency(self, node: NodeState, seconds: float):
+        if node.latency is None:
+            node.latency = seconds
+        else:
+            node.latency += self.ewma_alpha * (seconds - node.latency)
+
+    def mark_down(self, node: NodeState, e: Exception):
+        node.down_until = time.monotonic() + self.down_seconds
+        logger.warning("rpc node %s is down: %r", node.client.url, e)
+
+    async def check_node(self, node: NodeState):
+        start = time.monotonic()
+        try:
+            state = await asyncio.wait_for(node.client.get_blockchain_state(), self.health_check_timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.mark_down(node, e)
+            return
+        self.observe_latency(node, time.monotonic() - start)
+        node.peak_height = state['peak']['height'] if state['peak'] else 0
+        node.synced = state['sync']['synced']
+        node.down_until = 0.0
+
+    async def check_health(self):
+        await asyncio.gather(*[self.check_node(node) for node in self.nodes])
+        self.peak_height = max(self.peak_height or 0, *(node.peak_height for node in self.nodes))
+        self.peak_time = time.monotonic()
+
+    async def check_health_forever(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error("rpc health check error: %r", e, exc_info=True)
+
+    def candidates(self) -> List[NodeState]:
+        now = time.monotonic()
+        max_peak = max(node.peak_height for node in self.nodes)
+        healthy = [
+            node for node in self.nodes
+            if node.synced and node.peak_height + self.max_height_lag >= max_peak and node.down_until <= now
+        ]
+        if healthy:
+            return sorted(healthy, key=lambda node: node.load)
+        # no healthy node, try all of them, the ones cooling down last
+        return sorted(self.nodes, key=lambda node: (node.down_until > now, node.load))
+
+    async def fetch_from_nodes(self, method: str, path, request_json):
+        error = None
+        for node in self.candidates()[:self.retries_for(path) + 1]:
+            node.in_flight += 1
+            start = time.monotonic()
+            try:
+                res = await getattr(node.client, method)(path, request_json)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.mark_down(node, e)
+                error = e
+                continue
+            finally:
+                node.in_flight -= 1
+            self.observe_latency(node, time.monotonic() - start)
+            return res
+        raise error
+
+    # requests are coalesced by this client's fetch / raw_fetch, before they are routed
+
+    async def raw_fetch_once(self, path, request_json):
+        return await self.fetch_from_nodes('raw_fetch_once', path, request_json)
+
+    async def fetch_once(self, path, request_json) -> Any:
+        return await self.fetch_from_nodes('fetch_once', path, request_json)
+
+    def on_push_done(self, task: asyncio.Task):
+        self.push_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("push_tx error: %r", task.exception())
+
+    async def push_tx(self, spend_bundle: dict):
+        nodes = [node for node in self.nodes if node.synced] or self.nodes
+        tasks = [asyncio.create_task(node.client.push_tx(spend_bundle)) for node in nodes]
+        for task in tasks:
+            # the sends to the other nodes finish in the background after the first success
+            self.push_tasks.add(task)
+            task.add_done_callback(self.on_push_done)
+        errors = []
+        for fut in asyncio.as_completed(tasks):
+            try:
+                return await fut
+            except Exception as e:
+                errors.append(e)
+        # an error of a node (e.g. a double spend) is more useful than a connection error
+        for e in errors:
+            if isinstance(e, ValueError):
+                raise e
+        raise errors[0]
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return {
+            **({'response_cache': self.response_cache.stats()} if self.response_cache else {}),
+            'nodes': [{
+                'url': node.client.url,
+                'latency': node.latency,
+                'peak_height': node.peak_height,
+                'synced': node.synced,
+                'down': node.down_until > time.monotonic(),
+                **node.client.pool_stats(),
+            } for node in self.nodes]
+        }
+
+    async def close_sessions(self):
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+            await asyncio.gather(self.health_check_task, return_exceptions=True)
+        await asyncio.gather(*self.push_tasks, return_exceptions=True)
+        await asyncio.gather(*[node.client.close_sessions() for node in self.nodes])
+
+
+async def create_rpc_client(url_or_path: Union[str, List[str]], health_check_interval: float = 10, max_height_lag: int = 3,
+                            **options) -> FullNodeRpcClient:
+    """
+    url_or_path: a proxy url or a chia root path, or a list of them for a MultiNodeRpcClient
+    options: see FullNodeRpcClient.configure_policy and init_sessions
+    """
+    if not isinstance(url_or_path, str):
+        return await MultiNodeRpcClient.create(
+            list(url_or_path), health_check_interval=health_check_interval, max_height_lag=max_height_lag, **options)
+    if url_or_path.startswith('http'):
+        return await FullNodeRpcClient.create_by_proxy_url(url_or_path, **options)
+    return await FullNodeRpcClient.create_by_chia_root_path(url_or_path, **options)
@@ -0,0 +1,104 @@
+"""
+background scheduler for address asset syncs, so api requests only read the cached assets
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Tuple, Awaitable
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncScheduler:
+    """
+    - jobs are deduplicated by key, a key that is pending or running is not queued twice
+    - the most recently requested key runs first
+    - at most max_pending keys wait, the least recently requested one is dropped for a new key
+    - the keys whose last job failed or was dropped are remembered (at most max_pending of them) for status(),
+      until a later job of the key succeeds
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 10000):
+        self.workers = max(workers, 1)
+        self.max_pending = max(max_pending, 1)
+        # (-requested_at, seq, key), entries are dropped lazily when the key is requested again or dropped
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        # in request order, the least recently requested key first
+        self.pending: Dict[Hashable, Tuple[float, Callable[[], Awaitable]]] = OrderedDict()
+        self.running = set()
+        self.failed: Dict[Hashable, float] = OrderedDict()
+        self.seq = itertools.count()
+        self.new_job = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.worker()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, key: Hashable, coro_lambda: Callable[[], Awaitable]):
+        if key in self.running:
+            return
+        requested_at = time.monotonic()
+        self.pending.pop(key, None)
+        while len(self.pending) >= self.max_pending:
+            dropped, _ = self.pending.popitem(last=False)
+            logger.warning('sync job %s dropped, too many pending jobs', dropped)
+            # never synced, it is not 'synced' until it is requested again
+            self.set_failed(dropped)
+        self.pending[key] = (requested_at, coro_lambda)
+        heapq.heappush(self.heap, (-requested_at, next(self.seq), key))
+        if len(self.heap) > 2 * self.max_pending:
+            # too many stale entries
+            self.heap = [(-t, next(self.seq), k) for k, (t, _) in self.pending.items()]
+            heapq.heapify(self.heap)
+        self.new_job.set()
+
+    def status(self, key: Hashable) -> str:
+        if key in self.running:
+            return 'syncing'
+        if key in self.pending:
+            return 'pending'
+        if key in self.failed:
+            return 'error'
+        return 'synced'
+
+    def set_failed(self, key: Hashable):
+        self.failed.pop(key, None)
+        self.failed[key] = time.monotonic()
+        while len(self.failed) > self.max_pending:
+            self.failed.popitem(last=False)
+
+    async def worker(self):
+        while True:
+            while not self.heap:
+                self.new_job.clear()
+                await self.new_job.wait()
+
+            neg_requested_at, _, key = heapq.heappop(self.heap)
+            item = self.pending.get(key)
+            if item is None or item[0] != -neg_requested_at:
+                # requested again later, the newer entry is still in the heap
+                continue
+            del self.pending[key]
+
+            self.running.add(key)
+            try:
+                s = time.monotonic()
+                await item[1]()
+                logger.debug('sync job %s done, cost: %s', key, time.monotonic() - s)
+                self.failed.pop(key, None)
+            except Exception as e:
+                logger.error('sync job %s error: %s', key, e, exc_info=True)
+                self.set_failed(key)
+            finally:
+                self.running.discard(key)
@@ -0,0 +1,91 @@
+"""
+classify singleton coin spends, the singleton top layer is deserialized and uncurried once,
+then the inner puzzle is routed to the did or nft decoder by its mod hash
+"""
+import logging
+from dataclasses import dataclass
+from typing import Optional, Tuple, Any, Dict
+
+from .types import Coin, CoinSpend, Program
+from .puzzles import SINGLETON_TOP_LAYER_MOD, DID_INNERPUZ_MOD_HASH, NFT_STATE_LAYER_MOD_HASH
+from .did import get_did_info
+from .nft import UncurriedNFT, get_nft_info
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UncurriedSingleton:
+    singleton_struct: Program
+    inner_puzzle: Program
+    inner_mod_hash: bytes
+    inner_curried_args: Program
+
+
+# a curried singleton serializes as (a (q . SINGLETON_TOP_LAYER_MOD) args), other puzzles are skipped by this prefix
+SINGLETON_PUZZLE_HEX_PREFIX = 'ff02ffff01' + bytes(SINGLETON_TOP_LAYER_MOD).hex()
+
+
+def is_singleton_puzzle_hex(puzzle_hex: str) -> bool:
+    if puzzle_hex.startswith('0x'):
+        puzzle_hex = puzzle_hex[2:]
+    return puzzle_hex.startswith(SINGLETON_PUZZLE_HEX_PREFIX)
+
+
+def uncurry_singleton(puzzle: Program) -> Optional[UncurriedSingleton]:
+    try:
+        mod, curried_args = puzzle.uncurry()
+        if mod != SINGLETON_TOP_LAYER_MOD:
+            return None
+        singleton_struct, inner_puzzle = curried_args.as_iter()
+        inner_mod, inner_curried_args = inner_puzzle.uncurry()
+    except Exception:
+        return None
+    return UncurriedSingleton(singleton_struct, inner_puzzle, inner_mod.get_tree_hash(), inner_curried_args)
+
+
+def get_singleton_info_from_coin_spend(coin: Coin, parent_cs: CoinSpend, address: bytes) -> Tuple[Optional[str], Any]:
+    """
+    :return: ('did', did info) or ('nft', nft info), (None, None) for other coins
+    """
+    singleton = uncurry_singleton(parent_cs.puzzle_reveal)
+    if singleton is None:
+        return None, None
+
+    if singleton.inner_mod_hash == DID_INNERPUZ_MOD_HASH:
+        did_info = get_did_info(coin, parent_cs, singleton.inner_puzzle, singleton.inner_curried_args, address)
+        if did_info is not None:
+            return 'did', did_info
+
+    elif singleton.inner_mod_hash == NFT_STATE_LAYER_MOD_HASH:
+        try:
+            uncurried_nft = UncurriedNFT.from_nft_state_layer(
+                singleton.singleton_struct, singleton.inner_puzzle, singleton.inner_curried_args)
+        except Exception as e:
+            logger.debug('uncurry nft puzzle: %r', e)
+            return None, None
+        nft_info = get_nft_info(coin, parent_cs, uncurried_nft, address)
+        if nft_info is not None:
+            return 'nft', nft_info
+
+    return None, None
+
+
+def get_create_coin_hints(coin_spend: CoinSpend) -> Dict[Tuple[bytes, int], bytes]:
+    """
+    run the spend, the same way as the full node indexes hints
+    :return: (puzzle_hash, amount) of created coins -> hint
+    """
+    hints = {}
+    conditions = coin_spend.puzzle_reveal.run(coin_spend.solution)
+    for condition in conditions.as_iter():
+        if condition.list_len() < 4 or condition.first().as_int() != 51:
+            continue
+        memos = condition.at("rrrf")
+        if not memos.listp():
+            continue
+        hint = memos.first().atom
+        if hint is not None and len(hint) == 32:
+            hints[(condition.at("rf").as_atom(), condition.at("rrf").as_int())] = hint
+    return hints
@@ -2,24 +2,51 @@ import logging
 import asyncio
 import json
 import aiohttp
+from typing import Optional, List, Dict
 from aiocache import caches
 from .utils import hexstr_to_bytes, coin_name, to_hex, sha256
-from .types import Coin
+from .utils.lru_cache import LRUCache
+from .utils.singleflight import SingleFlight
+from .types import Coin, CoinSpend
 from .db import (
     Asset, NftMetadata, SingletonSpend,
-    get_db, save_asset, get_unspent_asset_coin_ids,
+    get_db, get_writer, save_assets, get_unspent_asset_coin_ids,
     update_asset_coin_spent_height, get_nft_metadata_by_hash, save_metadata,
     get_singelton_spend_by_id, delete_singleton_spend_by_id, save_singleton_spend,
     get_address_sync_height, save_address_sync_height, get_latest_tx_block_number,
 )
 
-from .did import get_did_info_from_coin_spend
-from .nft import get_nft_info_from_coin_spend
+from .singleton import get_singleton_info_from_coin_spend
 from .rpc_client import FullNodeRpcClient
+from .config import settings
 
 logger = logging.getLogger(__name__)
 
 
+# (chain_id, parent_coin_id, height) -> parsed parent coin spend, shared by all addresses
+coin_spend_cache = LRUCache(settings.get('SYNC', {}).get('coin_spend_cache_size', 500))
+coin_spend_sf = SingleFlight()
+
+# max concurrent get_puzzle_and_solution requests of one address sync
+SYNC_CONCURRENCY = max(settings.get('SYNC', {}).get('concurrency', 20), 1)
+
+# heights of one get_coin_records_by_hint request, the sync height is saved after each window
+SYNC_HEIGHT_WINDOW = max(settings.get('SYNC', {}).get('height_window', 500000), 1)
+
+
+async def get_parent_coin_spend(chain_id, parent_coin_id: bytes, height: int, client: FullNodeRpcClient) -> CoinSpend:
+    key = (chain_id, parent_coin_id, height)
+    coin_spend = coin_spend_cache.get(key)
+    if coin_spend is not None:
+        return coin_spend
+
+    async def fetch():
+        coin_spend = CoinSpend.from_json_dict(await client.get_puzzle_and_solution(parent_coin_id, height))
+        coin_spend_cache.put(key, coin_spend)
+        return coin_spend
+
+    return await coin_spend_sf.do(key, fetch)
+
 
 async def fetch_nft_metadata(db, url: str, hash: bytes):
     row = await get_nft_metadata_by_hash(db, hash)
@@ -44,11 +71,12 @@ async def fetch_nft_metadata(db, url: str, hash: bytes):
             logger.debug('fetch metadata: %s success', hash.hex())
 
 
-async def handle_coin(address, coin_record, parent_coin_spend, db):
+def handle_coin(address, coin_record, parent_coin_spend) -> Optional[Asset]:
     coin = Coin.from_json_dict(coin_record['coin'])
     logger.debug('handle coin: %s', coin.name().hex())
-    did_info = get_did_info_from_coin_spend(coin, parent_coin_spend, address)
-    if did_info is not None:
+    asset_type, asset_info = get_singleton_info_from_coin_spend(coin, parent_coin_spend, address)
+    if asset_type == 'did':
+        did_info = asset_info
         curried_params = {
             'recovery_list_hash': to_hex(did_info['recovery_list_hash']),
             'recovery_list': [to_hex(r) for r in did_info['recovery_list']],
@@ -66,14 +94,11 @@ async def handle_coin(address, coin_record, parent_coin_spend, db):
             p2_puzzle_hash=did_info['p2_puzzle_hash'],
             curried_params=curried_params,
         )
-
-        await save_asset(db, asset)
         logger.debug('new asset, type: %s, id: %s', asset.asset_type, asset.asset_id.hex())
-        return
+        return asset
 
-    nft_info = get_nft_info_from_coin_spend(coin, parent_coin_spend, address)
-    if nft_info is not None:
-        uncurried_nft, new_did_id, new_p2_puzhash, lineage_proof = nft_info
+    if asset_type == 'nft':
+        uncurried_nft, new_did_id, new_p2_puzhash, lineage_proof = asset_info
         curried_params = {
             'metadata': to_hex(bytes(uncurried_nft.metadata)),
             'transfer_program': to_hex(bytes(uncurried_nft.transfer_program) if uncurried_nft.transfer_program else None),
@@ -93,15 +118,46 @@ async def handle_coin(address, coin_record, parent_coin_spend, db):
             lineage_proof=lineage_proof.to_json_dict(),
             curried_params=curried_params
         )
-        await save_asset(db, asset)
         logger.info('new asset, address: %s, type: %s, id: %s', address.hex(), asset.asset_type, asset.asset_id.hex())
+        return asset
+
+
+async def handle_coins(chain_id, address: bytes, coin_records: List[Dict], client: FullNodeRpcClient) -> List[Asset]:
+    """
+    fetch parent coin spends with a bounded number of workers, each coin is handled as soon as its parent spend arrives
+    """
+    queue = asyncio.Queue()
+    for coin_record in coin_records:
+        queue.put_nowait(coin_record)
+
+    assets = []
+
+    async def worker():
+        while True:
+            try:
+                coin_record = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            parent_coin_spend = await get_parent_coin_spend(
+                chain_id, hexstr_to_bytes(coin_record['coin']['parent_coin_info']), coin_record['confirmed_block_index'], client)
+            asset = handle_coin(address, coin_record, parent_coin_spend)
+            if asset is not None:
+                assets.append(asset)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(SYNC_CONCURRENCY, len(coin_records)))]
+    try:
+        await asyncio.gather(*workers)
+    except Exception:
+        for w in workers:
+            w.cancel()
+        raise
+    return assets
 
 
 async def sync_user_assets(chain_id, address: bytes, client: FullNodeRpcClient):
     """
     sync did / nft by https://docs.chia.net/docs/12rpcs/full_node_api/#get_coin_records_by_hint
     """
-    # todo: use singleflight or use special process to sync
     db = get_db(chain_id)
 
     start_height_info = await get_address_sync_height(db, address)
@@ -119,20 +175,21 @@ async def sync_user_assets(chain_id, address: bytes, client: FullNodeRpcClient):
 
     logger.debug('chain: %s, address: %s, sync from %d to %d', chain_id, address.hex(), start_height, end_height)
 
-    coin_records = await client.get_coin_records_by_hint(
-        address, include_spent_coins=False, start_height=start_height, end_height=end_height+1)
-    
-    logger.debug('hint records: %d', len(coin_records))
-    if coin_records:
-        pz_and_solutions = await asyncio.gather(*[
-            client.get_puzzle_and_solution(hexstr_to_bytes(cr['coin']['parent_coin_info']), cr['confirmed_block_index'])
-            for cr in coin_records
-        ])
+    # walk the heights in windows and checkpoint after each one, so a failed sync resumes from the last window
+    for window_start in range(start_height, end_height + 1, SYNC_HEIGHT_WINDOW):
+        window_end = min(window_start + SYNC_HEIGHT_WINDOW - 1, end_height)
+        coin_records = await client.get_coin_records_by_hint(
+            address, include_spent_coins=False, start_height=window_start, end_height=window_end+1)
 
-        for coin_record, parent_coin_spend in zip(coin_records, pz_and_solutions):
-            await handle_coin(address, coin_record, parent_coin_spend, db)
+        logger.debug('hint records: %d, from %d to %d', len(coin_records), window_start, window_end)
+        assets = await handle_coins(chain_id, address, coin_records, client)
 
-    await save_address_sync_height(db, address, end_height)
+        # the assets and the sync height are committed together
+        async def save(db):
+            async with db.transaction():
+                await save_assets(db, assets)
+                await save_address_sync_height(db, address, window_end)
+        await get_writer(chain_id).run(save)
 
 
 
@@ -163,16 +220,16 @@ async def get_and_sync_singleton(chain_id, singleton_id: bytes, client: FullNode
     if odd_coin_record is None:
         if singleton_spend:
             # maybe reorg
-            await delete_singleton_spend_by_id(db, singleton_id)
+            await get_writer(chain_id).run(lambda db: delete_singleton_spend_by_id(db, singleton_id))
             return await get_and_sync_singleton(chain_id, singleton_id, client)
         else:
             raise ValueError("This is not a singleton")
 
     parent_coin_id = hexstr_to_bytes(odd_coin_record['coin']['parent_coin_info'])
-    await save_singleton_spend(db, SingletonSpend(
+    await get_writer(chain_id).run(lambda db: save_singleton_spend(db, SingletonSpend(
         singleton_id=singleton_id,
         coin_id=parent_coin_id,
-        spent_block_index=odd_coin_record['confirmed_block_index']))
+        spent_block_index=odd_coin_record['confirmed_block_index'])))
         
 
     coin_spend = await client.get_puzzle_and_solution(parent_coin_id, odd_coin_record['confirmed_block_index'])
@@ -123,6 +123,21 @@ class Program(SExp):
         cost, r = self.run_with_cost(INFINITE_COST, args)
         return r
 
+@dataclass(frozen=True)
+class CoinSpend:
+    coin: Coin
+    puzzle_reveal: Program
+    solution: Program
+
+    @classmethod
+    def from_json_dict(cls, json_dict: Dict[str, Any]) -> 'CoinSpend':
+        return cls(
+            Coin.from_json_dict(json_dict['coin']),
+            Program.fromhex(json_dict['puzzle_reveal']),
+            Program.fromhex(json_dict['solution']),
+        )
+
+
 @dataclass(frozen=True)
 class LineageProof:
     parent_name: Optional[bytes] = None
@@ -7,15 +7,24 @@ class SingleFlight:
 
     def __init__(self):
         self.key_future = {}
-        
+        # shared call -> callers waiting for it
+        self.waiters = {}
+
     async def do(self, key, coro_lambda):
-        if key in self.key_future:
-            return await self.key_future[key]
-        
-        fut = asyncio.ensure_future(coro_lambda())
-        self.key_future[key] = fut
+        fut = self.key_future.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(coro_lambda())
+            self.key_future[key] = fut
+            self.waiters[fut] = 0
+            fut.add_done_callback(lambda _: self.key_future.pop(key, None))
+        self.waiters[fut] += 1
         try:
-            res = await fut
-            return res
+            # a cancelled caller must not cancel the call shared with the others
+            return await asyncio.shield(fut)
         finally:
-            del self.key_future[key]
+            self.waiters[fut] -= 1
+            if not self.waiters[fut]:
+                del self.waiters[fut]
+                # but the call is cancelled with its last caller, nothing is left running
+                if not fut.done():
+                    fut.cancel()
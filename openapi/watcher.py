@@ -7,45 +7,157 @@ import argparse
 import json
 import logging
 import time
+import aiohttp
 import logzero
 from databases import Database
+from aiocache import caches
 from decimal import Decimal
 from datetime import datetime
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Optional
 from collections import defaultdict
-from .rpc_client import FullNodeRpcClient
+from .rpc_client import create_rpc_client
 from .db import (
-    get_latest_blocks, Block, get_block_by_height,
+    get_latest_blocks, Block, CoinRecord, get_block_by_height,
     reorg as reorg_db, save_block, update_asset_coin_spent_height,
+    save_coin_records, update_coin_record_spent_height, update_balances,
+    get_chain_state, save_chain_state, COIN_INDEX_START_HEIGHT,
+    get_latest_tx_block_number, has_address_sync, get_synced_addresses,
+    advance_address_sync_height, save_assets, Asset, check_schema_version, create_database,
 )
+from .singleton import is_singleton_puzzle_hex, uncurry_singleton, get_create_coin_hints
+from .sync import handle_coin
+from .types import CoinSpend
 from .utils import hexstr_to_bytes, coin_name
 
 
 logger = logging.getLogger("openapi.watcher")
 
 
+class PeakSubscriber:
+    """
+    listen to a websocket that pushes messages on new peaks, e.g. the chia daemon (wss://127.0.0.1:55400),
+    any message received wakes up the watcher
+    """
+    reconnect_interval = 3
+
+    def __init__(self, url: str, ssl_context=None):
+        self.url = url
+        self.ssl_context = ssl_context
+        self.connected = False
+        self.new_peak = asyncio.Event()
+
+    async def run(self):
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url, ssl=self.ssl_context or True, heartbeat=30, max_msg_size=0) as ws:
+                        # the full node only broadcasts peak changes to the wallet_ui service
+                        await ws.send_json({
+                            'command': 'register_service',
+                            'data': {'service': 'wallet_ui'},
+                            'ack': False,
+                            'origin': 'wallet_ui',
+                            'destination': 'daemon',
+                            'request_id': os.urandom(32).hex(),
+                        })
+                        self.connected = True
+                        logger.info("peak subscription connected: %s", self.url)
+                        async for msg in ws:
+                            if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                                self.new_peak.set()
+                            elif msg.type == aiohttp.WSMsgType.ERROR:
+                                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("peak subscription error: %s", e)
+            self.connected = False
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.new_peak.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.new_peak.clear()
+
+
 class Watcher:
-    def __init__(self, url_or_path: str, db: Database):
+    poll_interval = 3
+    # fallback polling while subscribed, in case a notification is missed
+    subscribed_poll_interval = 30
+
+    def __init__(self, url_or_path: str, db: Database, start_height: Optional[int] = None, prefetch_window: int = 1,
+                 peak_subscription_url: Optional[str] = None, catch_up_batch_size: int = 1, rpc_options: Optional[Dict] = None):
         self.url_or_path = url_or_path
+        # every block is read once, the rpc response cache is only for the api
+        self.rpc_options = {k: v for k, v in (rpc_options or {}).items() if k != 'response_cache'}
         self.client = None
         self.db = db
+        self.start_height = start_height
+        self.coin_index_start_height = None
+        self.last_tx_height = None
+        self.prefetch_window = max(prefetch_window, 1)
+        self.peak_subscription_url = peak_subscription_url
+        self.peak_subscriber = None
+        self.peak_subscriber_task: Optional[asyncio.Task] = None
+        # while catching up, blocks are committed in one transaction per batch
+        self.catch_up_batch_size = max(catch_up_batch_size, 1)
+        self.batch_transaction = None
+        self.batch_block_num = 0
+        self.batch_start_time = 0.0
+
+    async def begin_batch(self):
+        self.batch_transaction = await self.db.transaction().start()
+        self.batch_block_num = 0
+        self.batch_start_time = time.monotonic()
+
+    async def commit_batch(self):
+        if self.batch_transaction is None:
+            return
+        await self.batch_transaction.commit()
+        cost = time.monotonic() - self.batch_start_time
+        logger.info("commit %d blocks, %.1f blocks/s", self.batch_block_num, self.batch_block_num / cost if cost else 0)
+        logger.debug("rpc pool: %s", self.client.pool_stats())
+        self.batch_transaction = None
+
+    async def wait_for_peak(self):
+        if self.peak_subscriber and self.peak_subscriber.connected:
+            await self.peak_subscriber.wait(self.subscribed_poll_interval)
+        else:
+            await asyncio.sleep(self.poll_interval)
 
     async def reorg(self, block_height: int):
         # block height block is correct, +1 is error
         await reorg_db(self.db, block_height)
+        self.coin_index_start_height = await get_chain_state(self.db, COIN_INDEX_START_HEIGHT)
+        self.last_tx_height = await get_latest_tx_block_number(self.db)
         logger.info("reorg success: %d", block_height)
 
 
     async def start(self):
-        if self.url_or_path.startswith('http'):
-            self.client = await FullNodeRpcClient.create_by_proxy_url(self.url_or_path)
-        else:
-            self.client = await FullNodeRpcClient.create_by_chia_root_path(self.url_or_path)
+        self.client = await create_rpc_client(self.url_or_path, **self.rpc_options)
         await self.db.connect()
-        if "sqlite" in str(self.db.url):
-            await self.db.execute("PRAGMA journal_mode = WAL")
+        await check_schema_version(self.db)
+        if self.peak_subscription_url:
+            self.peak_subscriber = PeakSubscriber(self.peak_subscription_url, self.client.ssl_context)
+            self.peak_subscriber_task = asyncio.create_task(self.peak_subscriber.run())
+        try:
+            await self.follow_chain()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self.peak_subscriber_task is not None:
+            self.peak_subscriber_task.cancel()
+            await asyncio.gather(self.peak_subscriber_task, return_exceptions=True)
+            self.peak_subscriber_task = None
+        if self.client is not None:
+            self.client.close()
+            await self.client.await_closed()
 
+    async def follow_chain(self):
         try:
             prev_block = (await get_latest_blocks(self.db, 1))[0]
             prev_block = Block(
@@ -59,78 +171,224 @@ class Watcher:
 
         if prev_block:
             start_height = prev_block.height + 1
+        elif self.start_height is not None:
+            start_height = self.start_height
         else:
-            resp = await self.client.get_blockchain_state()
-            start_height = resp['peak']['height']
+            # from the genesis block, the api reads coins and balances from the coin index only when it covers every coin
+            start_height = 0
         logger.info("start height: %d", start_height)
-        while True:
-            
-            peak_height = (await self.client.get_blockchain_state())['peak']['height']
 
-            if start_height > peak_height:
-                time.sleep(3)
-                continue
-            
-            try:
-                bc = await self.client.get_block_record_by_height(start_height)
-            except Exception as e:
-                logger.error("fetch block error: %s", e)
-                time.sleep(3)
-                continue
-            
-            block = Block(
-                hash=hexstr_to_bytes(bc['header_hash']),
-                height=int(bc['height']),
-                timestamp=int(bc['timestamp'] or 0),
-                prev_hash=hexstr_to_bytes(bc['prev_hash']),
-                is_tx=bool(bc['timestamp']),
-            )
-    
-            logger.info("fetch block %d, %s, %d", start_height, block.hash.hex(), block.timestamp)
-
-            if prev_block and bytes(prev_block.hash) != bytes(block.prev_hash):
-                logger.warning("block chain reorg, prev: %d(%s), curr: %d(%s",
-                             prev_block.height, prev_block.hash.hex(), block.height, block.prev_hash.hex())
-                check_height = start_height - 1
-                while check_height:
-                    bc = await self.client.get_block_record_by_height(height=check_height)
-                    db_block = await get_block_by_height(self.db, check_height)
-                    if hexstr_to_bytes(bc['header_hash']) == bytes(db_block['hash']):
-                        prev_block = db_block
-                        break
-                    else:
-                        check_height -= 1
-                start_height = check_height  # will +1 in the func end
-
-                logger.info("reorg to height: %d", check_height)
-                await self.reorg(check_height)
-            else:
-                if block.is_tx:
+        self.coin_index_start_height = await get_chain_state(self.db, COIN_INDEX_START_HEIGHT)
+        if self.coin_index_start_height is None:
+            # coins confirmed before this height are not in the coin index
+            self.coin_index_start_height = start_height
+            await save_chain_state(self.db, COIN_INDEX_START_HEIGHT, start_height)
+        logger.info("coin index start height: %d", self.coin_index_start_height)
+        self.last_tx_height = await get_latest_tx_block_number(self.db)
+
+        # height -> task of fetch_block, at most prefetch_window blocks are in flight
+        prefetching: Dict[int, asyncio.Task] = {}
+        peak_height = -1
+        try:
+            while True:
+
+                if start_height > peak_height:
+                    await self.commit_batch()
+                    peak_height = (await self.client.get_blockchain_state())['peak']['height']
+                    if start_height > peak_height:
+                        await self.wait_for_peak()
+                        continue
+
+                for height in range(start_height, min(start_height + self.prefetch_window, peak_height + 1)):
+                    if height not in prefetching:
+                        prefetching[height] = asyncio.create_task(self.fetch_block(height))
+
+                try:
+                    block, additions, removals = await prefetching.pop(start_height)
+                except Exception as e:
+                    logger.error("fetch block error: %s", e)
+                    await self.commit_batch()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                logger.info("fetch block %d, %s, %d", start_height, block.hash.hex(), block.timestamp)
+
+                if prev_block and bytes(prev_block.hash) != bytes(block.prev_hash):
+                    logger.warning("block chain reorg, prev: %d(%s), curr: %d(%s",
+                                 prev_block.height, prev_block.hash.hex(), block.height, block.prev_hash.hex())
+                    # prefetched blocks may belong to the abandoned fork
+                    for task in prefetching.values():
+                        task.cancel()
+                    prefetching.clear()
+                    await self.commit_batch()
+
+                    check_height = start_height - 1
+                    while check_height:
+                        bc = await self.client.get_block_record_by_height(height=check_height)
+                        db_block = await get_block_by_height(self.db, check_height)
+                        if hexstr_to_bytes(bc['header_hash']) == bytes(db_block['hash']):
+                            prev_block = db_block
+                            break
+                        else:
+                            check_height -= 1
+                    start_height = check_height  # will +1 in the func end
+
+                    logger.info("reorg to height: %d", check_height)
+                    await self.reorg(check_height)
+                else:
+                    if self.batch_transaction is None and peak_height - start_height >= self.catch_up_batch_size:
+                        await self.begin_batch()
+
                     try:
-                        s = time.monotonic()
-                        await self.new_block(block)
-                        logger.info('block time cost: %s', time.monotonic() - s)
+                        # the block row and its index updates are committed together
+                        async with self.db.transaction():
+                            if block.is_tx:
+                                s = time.monotonic()
+                                await self.new_block(block, additions, removals)
+                                logger.info('block time cost: %s', time.monotonic() - s)
+                            await save_block(self.db, block)
                     except Exception as e:
                         logger.error("new block error: %s", e, exc_info=True)
+                        await self.commit_batch()
+                        await asyncio.sleep(self.poll_interval)
                         continue
-                    
-                await save_block(self.db, block)
-                prev_block = block
-            start_height += 1
+                    prev_block = block
+                    if self.batch_transaction is not None:
+                        self.batch_block_num += 1
+                        if self.batch_block_num >= self.catch_up_batch_size or start_height >= peak_height:
+                            await self.commit_batch()
+                start_height += 1
+        finally:
+            # a cancelled or failed watcher leaves no fetch running on the client that stop() closes
+            for task in prefetching.values():
+                task.cancel()
+            await asyncio.gather(*prefetching.values(), return_exceptions=True)
+
+    async def fetch_block(self, height: int):
+        bc = await self.client.get_block_record_by_height(height)
+        block = Block(
+            hash=hexstr_to_bytes(bc['header_hash']),
+            height=int(bc['height']),
+            timestamp=int(bc['timestamp'] or 0),
+            prev_hash=hexstr_to_bytes(bc['prev_hash']),
+            is_tx=bool(bc['timestamp']),
+        )
+        additions, removals = [], []
+        if block.is_tx:
+            additions, removals = await self.client.get_additions_and_removals(block.hash, block.height)
+        return block, additions, removals
+
+    async def new_block(self, block: Block, additions: List[Dict], removals: List[Dict]):
+        # puzzle_hash -> [amount delta, coin_num delta]
+        balance_changes = defaultdict(lambda: [0, 0])
 
-    async def new_block(self, block: Block):
-        additions, removals = await self.client.get_additions_and_removals(block.hash)
+        new_coin_records = []
+        for coin_record in additions:
+            coin = coin_record['coin']
+            puzzle_hash = hexstr_to_bytes(coin['puzzle_hash'])
+            new_coin_records.append(CoinRecord(
+                coin_id=coin_name(**coin),
+                puzzle_hash=puzzle_hash,
+                coin=coin,
+                confirmed_height=block.height,
+                spent_height=0,
+            ))
+            balance_changes[puzzle_hash][0] += coin['amount']
+            balance_changes[puzzle_hash][1] += 1
 
         removals_id = []
+        odd_removals_id = set()
         for coin_record in removals:
-            coin_id = coin_name(**coin_record['coin'])
+            coin = coin_record['coin']
+            coin_id = coin_name(**coin)
             removals_id.append(coin_id)
-        
-        await update_asset_coin_spent_height(self.db, removals_id, block.height)
+            if coin['amount'] % 2 == 1:
+                odd_removals_id.add(coin_id)
+            if coin_record['confirmed_block_index'] >= self.coin_index_start_height:
+                # coins before the index start height are not in the balances
+                puzzle_hash = hexstr_to_bytes(coin['puzzle_hash'])
+                balance_changes[puzzle_hash][0] -= coin['amount']
+                balance_changes[puzzle_hash][1] -= 1
+
+        assets = await self.get_synced_address_assets(block, additions, odd_removals_id)
+
+        async with self.db.transaction():
+            # a coin can be created and spent in the same block
+            await save_coin_records(self.db, new_coin_records)
+            await update_coin_record_spent_height(self.db, removals_id, block.height)
+            await update_balances(self.db, balance_changes, block.height)
+            await save_assets(self.db, assets)
+            await update_asset_coin_spent_height(self.db, removals_id, block.height)
+            if self.last_tx_height is not None:
+                # the assets of this block are saved, addresses synced to the previous tx block are up to date
+                await advance_address_sync_height(self.db, self.last_tx_height, block.height)
+        self.last_tx_height = block.height
+
+    async def get_synced_address_assets(self, block: Block, additions: List[Dict], odd_removals_id: set) -> List[Asset]:
+        """
+        decode the singleton coins of the block that are hinted to addresses in address_sync,
+        odd_removals_id: the spent coins of odd amounts, singleton coins and their parents (a singleton or its launcher)
+        have odd amounts
+        """
+        odd_additions = [
+            cr for cr in additions
+            if cr['coin']['amount'] % 2 == 1 and not cr.get('coinbase')
+            and hexstr_to_bytes(cr['coin']['parent_coin_info']) in odd_removals_id
+        ]
+        if not odd_additions or not await has_address_sync(self.db):
+            return []
+
+        block_spends = {}
+        for cs in await self.client.get_block_spends(block.hash, block.height):
+            block_spends[coin_name(**cs['coin'])] = cs
+
+        # parent coin id -> (parsed spend, hints), None for non singleton spends
+        parents = {}
+        hinted = []
+        for coin_record in odd_additions:
+            parent_id = hexstr_to_bytes(coin_record['coin']['parent_coin_info'])
+            if parent_id not in parents:
+                parents[parent_id] = None
+                if parent_id in block_spends and is_singleton_puzzle_hex(block_spends[parent_id]['puzzle_reveal']):
+                    parent_cs = CoinSpend.from_json_dict(block_spends[parent_id])
+                    if uncurry_singleton(parent_cs.puzzle_reveal) is not None:
+                        try:
+                            parents[parent_id] = (parent_cs, get_create_coin_hints(parent_cs))
+                        except Exception as e:
+                            logger.warning("run singleton spend %s error: %s", parent_id.hex(), e)
+            if parents[parent_id] is None:
+                continue
+            parent_cs, hints = parents[parent_id]
+            coin = coin_record['coin']
+            hint = hints.get((hexstr_to_bytes(coin['puzzle_hash']), coin['amount']))
+            if hint is not None:
+                hinted.append((hint, coin_record, parent_cs))
+
+        if not hinted:
+            return []
+        synced_addresses = set(await get_synced_addresses(self.db, list({hint for hint, _, _ in hinted})))
+        assets = []
+        for hint, coin_record, parent_cs in hinted:
+            if hint not in synced_addresses:
+                continue
+            try:
+                asset = handle_coin(hint, coin_record, parent_cs)
+            except Exception as e:
+                # a coin the decoders do not understand must not stop the watcher at this block
+                logger.warning("decode coin %s of %s error: %s", coin_record['coin']['parent_coin_info'], hint.hex(), e)
+                continue
+            if asset is not None:
+                assets.append(asset)
+        if assets:
+            logger.info("block %d, new assets of synced addresses: %d", block.height, len(assets))
+        return assets
 
 
-async def main(networks: List[str] = None):
+async def main(networks: List[str] = None, start_height: Optional[int] = None):
     from .config import settings
+    # for the aiocache backend of the rpc response cache
+    caches.set_config({'default': settings.CACHE})
+    watcher_settings = settings.get('WATCHER', {})
     tasks = []
     for row in settings.SUPPORTED_CHAINS.values():
 
@@ -141,17 +399,30 @@ async def main(networks: List[str] = None):
             if row['network_name'] not in networks:
                 continue
         
-        db = Database(row['database_uri'])
-        tasks.append(Watcher(row['rpc_url_or_chia_path'], db).start())
+        rpc_url_or_chia_path = row['rpc_url_or_chia_path']
+        if not isinstance(rpc_url_or_chia_path, str):
+            # blocks must come from one chain view, the watcher only follows the first node
+            rpc_url_or_chia_path = rpc_url_or_chia_path[0]
+        db = create_database(row['database_uri'])
+        watcher = Watcher(
+            rpc_url_or_chia_path, db, start_height,
+            prefetch_window=watcher_settings.get('prefetch_window', 1),
+            peak_subscription_url=row.get('peak_subscription_url'),
+            catch_up_batch_size=watcher_settings.get('catch_up_batch_size', 1),
+            rpc_options=settings.get('RPC', {}),
+        )
+        tasks.append(watcher.start())
     await asyncio.gather(*tasks)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--networks', nargs='+', help='networks to watch')
+    parser.add_argument('--start-height', type=int, help='height to start from on an empty database, default is the genesis block. '
+                        'the api reads coins and balances from the coin index only when it starts from the genesis block')
     args = parser.parse_args()
     from . import log_dir
     from .config import settings
     logzero.setup_logger(
     'openapi', level=logging.getLevelName(settings['LOG_LEVEL']), logfile=os.path.join(log_dir, "watcher.log"),
     disableStderrLogger=True)
-    asyncio.run(main(args.networks))
+    asyncio.run(main(args.networks, args.start_height))
@@ -0,0 +1,10 @@
+import os
+import shutil
+import tempfile
+
+# openapi reads its settings and opens its log file at import, the tests run with the default settings
+# and keep their logs out of the repo
+test_dir = tempfile.mkdtemp(prefix='openapi-test-')
+shutil.copy(os.path.join(os.path.dirname(__file__), '..', 'settings.toml.default'), os.path.join(test_dir, 'settings.toml'))
+os.environ.setdefault('SETTINGS_FILE_FOR_DYNACONF', os.path.join(test_dir, 'settings.toml'))
+os.environ.setdefault('DYNACONF_LOG_DIR', test_dir)
@@ -0,0 +1,65 @@
+"""
+every get_assets filter combination of /v1/assets must search an index in its order, without a scan or a sort
+"""
+import sqlite3
+import pytest
+from sqlalchemy.dialects import sqlite
+from openapi.db import get_assets
+from openapi.migrations import migrate
+
+
+class CompileOnlyDB:
+    def fetch_all(self, query):
+        return query
+
+
+P2 = b'p' * 32
+DID = b'd' * 32
+ASSET_ID = b'a' * 32
+CURSOR = (100, b'c' * 32)
+
+
+@pytest.fixture(scope='module')
+def conn(tmp_path_factory):
+    path = tmp_path_factory.mktemp('db') / 'assets.db'
+    migrate(f'sqlite+aiosqlite:///{path}')
+    conn = sqlite3.connect(path)
+    rows = [
+        (bytes([i]) * 32, 'nft' if i % 2 else 'did', ASSET_ID if i % 3 else bytes([i]) * 32, i, 0 if i % 4 else i + 1,
+         '{}', '{}', P2 if i % 2 else bytes([i]) * 32, DID if i % 5 else None, '{}')
+        for i in range(200)
+    ]
+    conn.executemany('INSERT INTO asset VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, **filters):
+    compiled = get_assets(CompileOnlyDB(), limit=10, **filters).compile(dialect=sqlite.dialect())
+    params = [compiled.params[key] for key in compiled.positiontup]
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+
+
+@pytest.mark.parametrize('filters, index', [
+    (dict(asset_type='nft', p2_puzzle_hash=P2), 'ix_asset_p2_type_spent_confirmed_coin'),
+    (dict(asset_type='nft', p2_puzzle_hash=P2, cursor=CURSOR), 'ix_asset_p2_type_spent_confirmed_coin'),
+    (dict(asset_type='nft', p2_puzzle_hash=P2, asset_id=ASSET_ID), 'ix_asset_p2_type_asset_id_confirmed_unspent'),
+    (dict(asset_type='nft', p2_puzzle_hash=P2, asset_id=ASSET_ID, cursor=CURSOR), 'ix_asset_p2_type_asset_id_confirmed_unspent'),
+    (dict(asset_type='nft', nft_did_id=DID), 'ix_asset_did_type_confirmed_unspent'),
+    (dict(asset_type='nft', nft_did_id=DID, cursor=CURSOR), 'ix_asset_did_type_confirmed_unspent'),
+])
+def test_get_assets_uses_index(conn, filters, index):
+    plan = query_plan(conn, **filters)
+    assert len(plan) == 1, plan
+    assert plan[0].startswith('SEARCH asset USING') and index in plan[0], plan
+
+
+@pytest.mark.parametrize('filters', [
+    dict(asset_type='nft', p2_puzzle_hash=P2, cursor=CURSOR),
+    dict(asset_type='nft', p2_puzzle_hash=P2, asset_id=ASSET_ID, cursor=CURSOR),
+    dict(asset_type='nft', nft_did_id=DID, cursor=CURSOR),
+])
+def test_get_assets_cursor_is_an_index_range(conn, filters):
+    plan = query_plan(conn, **filters)
+    assert '(confirmed_height,coin_id)>(?,?)' in plan[0], plan
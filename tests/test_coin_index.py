@@ -0,0 +1,132 @@
+"""
+/v1/utxos and /v1/balance read the watcher's coin index, and the few blocks after it from the full node
+"""
+import asyncio
+import itertools
+from typing import Dict
+import pytest
+from openapi import api
+from openapi.db import (
+    KEY_DBS, KEY_WRITERS, COIN_INDEX_START_HEIGHT, Block, CoinRecord, connect_db, disconnect_db, get_db, register_db,
+    save_block, save_chain_state, save_coin_records, update_balances,
+)
+from openapi.migrations import migrate
+from openapi.utils import coin_name
+
+
+PH = b'p' * 32
+chain_ids = itertools.count()
+
+
+def make_coin(parent: bytes, amount: int) -> Dict:
+    return {'parent_coin_info': '0x' + parent.hex(), 'puzzle_hash': '0x' + PH.hex(), 'amount': amount}
+
+
+# PH holds 3 coins of 1 in the indexed blocks
+INDEXED_COINS = [make_coin(bytes([i]) * 32, 1) for i in range(3)]
+NODE_COIN = make_coin(b'n' * 32, 7)
+
+
+class FakeNode:
+    """
+    block 101 spends the first indexed coin and creates a coin of 5, block 102 is not a transaction block
+    """
+    def __init__(self, peak: int):
+        self.peak = peak
+        self.calls = []
+
+    async def get_peak_height(self, max_age: float) -> int:
+        return self.peak
+
+    async def get_coin_records_by_puzzle_hashes(self, puzzle_hashes, include_spent_coins, start_height=None, end_height=None):
+        self.calls.append('get_coin_records_by_puzzle_hashes')
+        return [{'coin': NODE_COIN, 'spent': False}]
+
+    async def get_block_record_by_height(self, height: int):
+        self.calls.append('get_block_record_by_height')
+        return {'header_hash': '0x' + bytes([height]).hex() * 32, 'timestamp': 1 if height % 2 else None}
+
+    async def get_additions_and_removals(self, header_hash: bytes, height: int):
+        self.calls.append('get_additions_and_removals')
+        return [{'coin': make_coin(header_hash, 5)}], [{'coin': INDEXED_COINS[0]}]
+
+
+async def index_chain(chain_id: str, start_height: int, end_height: int):
+    """
+    the watcher indexed [start_height, end_height]
+    """
+    db = get_db(chain_id)
+    await save_chain_state(db, COIN_INDEX_START_HEIGHT, start_height)
+    await save_block(db, Block(hash=b'h' * 32, height=end_height, timestamp=1, prev_hash=b'0' * 32, is_tx=True))
+    await save_coin_records(db, [
+        CoinRecord(coin_id=coin_name(**coin), puzzle_hash=PH, coin=coin, confirmed_height=end_height, spent_height=0)
+        for coin in INDEXED_COINS
+    ])
+    await update_balances(db, {PH: (3, 3)}, end_height)
+
+
+@pytest.fixture
+def run(tmp_path):
+    """
+    runs a coroutine function with a migrated database registered as its chain id
+    """
+    def run(coro_func, *args):
+        chain_id = f'test{next(chain_ids)}'
+        uri = f'sqlite+aiosqlite:///{tmp_path / chain_id}.db'
+        migrate(uri)
+        register_db(chain_id, uri)
+
+        async def main():
+            await connect_db(chain_id)
+            try:
+                return await coro_func(chain_id, *args)
+            finally:
+                await disconnect_db(chain_id)
+                del KEY_DBS[chain_id], KEY_WRITERS[chain_id]
+        return asyncio.run(main())
+    return run
+
+
+async def read_utxos(chain_id: str, start_height: int, end_height: int, peak: int):
+    await index_chain(chain_id, start_height, end_height)
+    node = FakeNode(peak)
+    coins = await api.get_unspent_coins(api.Chain(chain_id, 'test', 'xch', node), [PH])
+    return [coin['amount'] for coin in coins[PH]], node.calls
+
+
+def test_utxos_at_the_peak_need_no_node_scan(run):
+    assert run(read_utxos, 0, 100, 100) == ([1, 1, 1], [])
+
+
+def test_utxos_of_the_blocks_past_the_index_are_read_from_their_additions_and_removals(run):
+    assert run(read_utxos, 0, 100, 102) == ([1, 1, 5], [
+        'get_block_record_by_height', 'get_additions_and_removals', 'get_block_record_by_height'])
+
+
+def test_utxos_are_read_from_the_node_while_the_watcher_lags(run):
+    assert run(read_utxos, 0, 100, 100 + api.COIN_INDEX_MAX_LAG + 1) == ([7], ['get_coin_records_by_puzzle_hashes'])
+
+
+def test_utxos_are_read_from_the_node_when_the_index_does_not_start_from_genesis(run):
+    assert run(read_utxos, 50, 100, 100) == ([7], ['get_coin_records_by_puzzle_hashes'])
+
+
+async def read_balance(chain_id: str, start_height: int, end_height: int, peak: int):
+    await index_chain(chain_id, start_height, end_height)
+    node = FakeNode(peak)
+    balances = await api.get_address_balances(api.Chain(chain_id, 'test', 'xch', node), [PH, b'e' * 32])
+    return balances[PH], balances[b'e' * 32], node.calls
+
+
+def test_balance_at_the_peak_needs_no_node_scan(run):
+    assert run(read_balance, 0, 100, 100) == ({'amount': 3, 'coin_num': 3}, {'amount': 0, 'coin_num': 0}, [])
+
+
+def test_balance_applies_the_blocks_past_the_index(run):
+    assert run(read_balance, 0, 100, 102) == ({'amount': 7, 'coin_num': 3}, {'amount': 0, 'coin_num': 0}, [
+        'get_block_record_by_height', 'get_additions_and_removals', 'get_block_record_by_height'])
+
+
+def test_balance_is_read_from_the_node_while_the_watcher_lags(run):
+    assert run(read_balance, 0, 100, 100 + api.COIN_INDEX_MAX_LAG + 1) == (
+        {'amount': 7, 'coin_num': 1}, {'amount': 0, 'coin_num': 0}, ['get_coin_records_by_puzzle_hashes'])
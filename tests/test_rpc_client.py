@@ -0,0 +1,231 @@
+"""
+routing, failover, retries and coalescing of the rpc clients, against local aiohttp stand-ins of the full node
+"""
+import asyncio
+import collections
+import time
+from typing import Optional
+import pytest
+from aiohttp import web
+from openapi.rpc_client import CircuitOpenError, FullNodeRpcClient, MultiNodeRpcClient, create_rpc_client
+
+
+PEAK = 1000
+COIN_ID = b'c' * 32
+
+
+class StandInNode:
+    """
+    answers every rpc method after delay seconds, with status 500 while failing
+    """
+    def __init__(self, peak: int = PEAK, synced: bool = True, delay: float = 0, push_error: Optional[str] = None):
+        self.peak = peak
+        self.synced = synced
+        self.delay = delay
+        self.push_error = push_error
+        self.failing = False
+        self.hits = collections.Counter()
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ''
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.hits[method] += 1
+        await asyncio.sleep(self.delay)
+        if self.failing:
+            return web.json_response({'success': False}, status=500)
+        if method == 'push_tx' and self.push_error:
+            return web.json_response({'success': False, 'error': self.push_error})
+        return web.json_response({
+            'success': True,
+            'blockchain_state': {'peak': {'height': self.peak}, 'sync': {'synced': self.synced}},
+            'coin_record': {'url': self.url},
+            'status': 'SUCCESS',
+            'url': self.url,
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def requests(self, method: str = 'get_coin_record_by_name') -> int:
+        return self.hits[method]
+
+
+def run_with_nodes(coro_func, *nodes: StandInNode, **options):
+    """
+    runs coro_func(client) with a client of the started nodes, a MultiNodeRpcClient for more than one node
+    """
+    async def main():
+        for node in nodes:
+            await node.start()
+        urls = [node.url for node in nodes]
+        client = await create_rpc_client(urls if len(urls) > 1 else urls[0], **options)
+        try:
+            return await coro_func(client)
+        finally:
+            client.close()
+            await client.await_closed()
+            for node in nodes:
+                await node.stop()
+    return asyncio.run(main())
+
+
+def test_requests_go_to_the_node_with_the_lowest_load():
+    slow, fast = StandInNode(delay=0.05), StandInNode()
+
+    async def main(client: MultiNodeRpcClient):
+        for _ in range(5):
+            assert (await client.get_coin_record_by_name(COIN_ID))['url'] == fast.url
+        # the latency of the fast node grows with its in-flight requests, the slow node takes the rest
+        client.nodes[1].in_flight = 100
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == slow.url
+
+    run_with_nodes(main, slow, fast)
+    assert (slow.requests(), fast.requests()) == (1, 5)
+
+
+def test_syncing_and_lagging_nodes_are_skipped():
+    syncing, lagging, healthy = StandInNode(synced=False), StandInNode(peak=PEAK - 4), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        for _ in range(3):
+            assert (await client.get_coin_record_by_name(COIN_ID))['url'] == healthy.url
+
+    run_with_nodes(main, syncing, lagging, healthy, max_height_lag=3)
+    assert (syncing.requests(), lagging.requests(), healthy.requests()) == (0, 0, 3)
+
+
+def test_a_node_within_the_height_lag_is_healthy():
+    behind, slow = StandInNode(peak=PEAK - 3), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == behind.url
+
+    run_with_nodes(main, behind, slow, max_height_lag=3)
+
+
+def test_requests_fail_over_when_a_node_goes_down():
+    fast, slow = StandInNode(), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == fast.url
+        await fast.stop()
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == slow.url
+        # the down node cools down, the next request goes straight to the other one
+        assert client.nodes[0].down_until > time.monotonic()
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == slow.url
+        await fast.start()
+
+    run_with_nodes(main, fast, slow)
+    assert (fast.requests(), slow.requests()) == (1, 2)
+
+
+def test_requests_fail_over_on_a_server_error():
+    failing, slow = StandInNode(), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        failing.failing = True
+        assert (await client.get_coin_record_by_name(COIN_ID))['url'] == slow.url
+
+    run_with_nodes(main, failing, slow)
+    # the node is not retried by its own client
+    assert (failing.requests(), slow.requests()) == (1, 1)
+
+
+def test_push_tx_returns_the_first_success():
+    rejecting, slow, fast = StandInNode(push_error='DOUBLE_SPEND'), StandInNode(delay=0.5), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        start = time.monotonic()
+        assert (await client.push_tx({}))['url'] == fast.url
+        assert time.monotonic() - start < 0.5
+        return len(client.push_tasks)
+
+    # the push to the slow node is still running, close waits for it
+    assert run_with_nodes(main, rejecting, slow, fast) == 1
+    assert [node.requests('push_tx') for node in (rejecting, slow, fast)] == [1, 1, 1]
+
+
+def test_push_tx_raises_the_error_of_a_node():
+    rejecting, down = StandInNode(push_error='DOUBLE_SPEND'), StandInNode()
+
+    async def main(client: MultiNodeRpcClient):
+        await down.stop()
+        with pytest.raises(ValueError, match='DOUBLE_SPEND'):
+            await client.push_tx({})
+        await down.start()
+
+    run_with_nodes(main, rejecting, down)
+
+
+def test_idempotent_requests_are_retried_within_their_budget():
+    node = StandInNode()
+    node.failing = True
+
+    async def main(client: FullNodeRpcClient):
+        for request in (client.get_coin_record_by_name(COIN_ID), client.get_block_record_by_height(1), client.push_tx({})):
+            with pytest.raises(Exception):
+                await request
+
+    run_with_nodes(main, node, retries=2, method_retries={'get_block_record_by_height': 0}, backoff=0,
+                   breaker_failures=100)
+    assert (node.requests(), node.requests('get_block_record_by_height'), node.requests('push_tx')) == (3, 1, 1)
+
+
+def test_the_breaker_fails_fast_until_a_probe_succeeds():
+    node = StandInNode()
+    node.failing = True
+
+    async def main(client: FullNodeRpcClient):
+        for _ in range(2):
+            with pytest.raises(Exception):
+                await client.get_coin_record_by_name(COIN_ID)
+        with pytest.raises(CircuitOpenError):
+            await client.get_coin_record_by_name(COIN_ID)
+        assert client.pool_stats()['circuit_open']
+        node.failing = False
+        await asyncio.sleep(0.2)
+        await client.get_coin_record_by_name(COIN_ID)
+        assert not client.pool_stats()['circuit_open']
+
+    run_with_nodes(main, node, retries=0, breaker_failures=2, breaker_reset=0.1)
+    # the failing fast request never reached the node
+    assert node.requests() == 3
+
+
+def test_identical_requests_in_flight_share_one_call():
+    node = StandInNode(delay=0.05)
+
+    async def main(client: FullNodeRpcClient):
+        await asyncio.gather(*[client.get_coin_record_by_name(COIN_ID) for _ in range(20)],
+                             *[client.get_coin_record_by_name(b'd' * 32) for _ in range(5)],
+                             *[client.push_tx({}) for _ in range(3)])
+        # a cancelled caller leaves the shared call to the others
+        first = asyncio.ensure_future(client.get_coin_record_by_name(b'e' * 32))
+        second = asyncio.ensure_future(client.get_coin_record_by_name(b'e' * 32))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert (await second)['url'] == node.url
+
+    run_with_nodes(main, node)
+    assert (node.requests(), node.requests('push_tx')) == (3, 3)
+
+
+def test_identical_requests_are_coalesced_before_they_are_routed():
+    nodes = StandInNode(delay=0.05), StandInNode(delay=0.05)
+
+    async def main(client: MultiNodeRpcClient):
+        await asyncio.gather(*[client.get_coin_record_by_name(COIN_ID) for _ in range(20)])
+
+    run_with_nodes(main, *nodes)
+    assert sum(node.requests() for node in nodes) == 1